@@ -0,0 +1,383 @@
+# Offline benchmark for a full broker cycle.
+#
+# Runs stand-ins for the UISP API, the Zabbix JSON-RPC API and the Zabbix
+# trapper in a separate process, points the real clients at them, and times
+# one or more poll cycles over a synthetic /data-links payload:
+#
+#     python bench.py --links 1000 10000 100000 --cycles 3
+#
+# Reports per-stage time, peak RSS of the broker process and values/sec.
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socketserver
+import struct
+import threading
+import time
+import zlib
+
+from datalink import STATISTICS_FIELDS
+
+
+# Builds a /data-links payload with n links, in the same shape UISP returns
+# and DataLink reads. ptp_ratio of them are PtP links that pass the filter.
+def make_data_links(n, ptp_ratio=0.8, seed=0):
+    rng = random.Random(seed)
+
+    def side(i, end, mode):
+        statistics = {f: rng.randint(0, 1000000) for f in STATISTICS_FIELDS}
+        statistics.update(
+            downlinkUtilization=rng.random(),
+            uplinkUtilization=rng.random(),
+            linkScore=rng.random(),
+            linkScoreHint="Link is fine",
+        )
+        return {
+            "site": {
+                "identification": {
+                    "id": f"site-{i}-{end}",
+                    "name": f"Site {i}{end}",
+                    "status": "active",
+                    "type": "site",
+                }
+            },
+            "device": {
+                "identification": {
+                    "id": f"device-{i}-{end}",
+                    "name": f"nycmesh-{i}-{end}",
+                    "model": rng.choice(["AF60-XR", "AF60-LR", "LTU-XR"]),
+                    "type": "airFiber",
+                    "category": "wireless",
+                    "role": "ap" if end == "a" else "station",
+                },
+                "overview": {"wirelessMode": mode, "status": "active"},
+            },
+            "interface": {"id": "main", "statistics": statistics},
+        }
+
+    links = []
+    for i in range(n):
+        ptp = rng.random() < ptp_ratio
+        links.append(
+            {
+                "id": f"link-{i}",
+                "ssid": f"nycmesh-{i}" if ptp else None,
+                "signal": rng.randint(-80, -40),
+                "frequency": rng.choice([5180, 5500, 60480]),
+                "type": "wireless",
+                "state": "active",
+                "from": side(i, "a", "ap-ptp" if ptp else "ap-ptmp"),
+                "to": side(i, "b", "sta-ptp" if ptp else "sta-ptmp"),
+            }
+        )
+    return links
+
+
+def _uisp_handler(body, gzipped):
+    class UISPHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/data-links":
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            payload = body
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                payload = gzipped
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return UISPHandler
+
+
+# Just enough of the Zabbix JSON-RPC API for ZabbixClient: objects are kept
+# in memory by type and get/create/update/massupdate/delete act on them
+class _ZabbixHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    objects = {}
+    next_id = [1]
+
+    ID_FIELDS = {
+        "host": "hostid",
+        "template": "templateid",
+        "item": "itemid",
+        "hostgroup": "groupid",
+        "templategroup": "groupid",
+        "discoveryrule": "itemid",
+        "itemprototype": "itemid",
+        "hostprototype": "hostid",
+    }
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        try:
+            result = self._call(request["method"], request.get("params") or {})
+            response = {"jsonrpc": "2.0", "result": result, "id": request["id"]}
+        except Exception as e:
+            response = {
+                "jsonrpc": "2.0",
+                "error": {"code": -32602, "message": "Invalid params.", "data": str(e)},
+                "id": request["id"],
+            }
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _call(self, method, params):
+        if method == "apiinfo.version":
+            return "6.4.0"
+        if method == "user.login":
+            return "benchtoken"
+        if method in ("user.logout", "user.checkAuthentication"):
+            return True
+
+        kind, action = method.split(".")
+        id_field = self.ID_FIELDS[kind]
+        store = self.objects.setdefault(kind, {})
+        many = params if isinstance(params, list) else [params]
+
+        if action == "get":
+            return [o for o in store.values() if self._matches(o, params)]
+        if action == "create":
+            ids = []
+            for p in many:
+                obj = dict(p, **{id_field: str(self.next_id[0])})
+                self.next_id[0] += 1
+                if kind == "host":
+                    obj["hostgroups"] = p.get("groups", [])
+                    obj["parentTemplates"] = p.get("templates", [])
+                store[obj[id_field]] = obj
+                ids.append(obj[id_field])
+            return {f"{id_field}s": ids}
+        if action == "update":
+            for p in many:
+                store[p[id_field]].update(p)
+            return {f"{id_field}s": [p[id_field] for p in many]}
+        if action == "massupdate":
+            for h in params["hosts"]:
+                store[h[id_field]]["hostgroups"] = params.get("groups", [])
+                store[h[id_field]]["parentTemplates"] = params.get("templates", [])
+            return {f"{id_field}s": [h[id_field] for h in params["hosts"]]}
+        if action == "delete":
+            for i in many:
+                store.pop(i, None)
+            return {f"{id_field}s": many}
+        raise ValueError(f"Unsupported method {method}")
+
+    @staticmethod
+    def _matches(obj, params):
+        for field, wanted in (params.get("filter") or {}).items():
+            wanted = wanted if isinstance(wanted, list) else [wanted]
+            if obj.get(field) not in wanted:
+                return False
+        if "groupids" in params:
+            groups = {g["groupid"] for g in obj.get("hostgroups", [])}
+            if not groups & set(params["groupids"]):
+                return False
+        # Items point at their template through hostid
+        template_id = obj.get("templateid") or obj.get("hostid")
+        if "templateids" in params and template_id not in params["templateids"]:
+            return False
+        if "hostids" in params and obj.get("hostid") not in params["hostids"]:
+            return False
+        if "discoveryids" in params and obj.get("ruleid") not in params["discoveryids"]:
+            return False
+        return True
+
+
+# Speaks the trapper side of the Zabbix sender protocol and counts values
+class _TrapperHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        header = self._read(13)
+        _, flags, length, uncompressed = struct.unpack("<4scLL", header)
+        data = self._read(length)
+        if ord(flags) & 2:
+            data = zlib.decompress(data)
+        total = len(json.loads(data)["data"])
+        body = json.dumps(
+            {
+                "response": "success",
+                "info": f"processed: {total}; failed: 0; total: {total}; "
+                "seconds spent: 0.000100",
+            }
+        ).encode()
+        self.request.sendall(b"ZBXD\x01" + struct.pack("<Q", len(body)) + body)
+
+    def _read(self, n):
+        buf = b""
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("Sender hung up")
+            buf += chunk
+        return buf
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _serve_fakes(links, conn):
+    body = json.dumps(make_data_links(links)).encode()
+    servers = [
+        ThreadingHTTPServer(
+            ("127.0.0.1", 0), _uisp_handler(body, gzip.compress(body, 1))
+        ),
+        ThreadingHTTPServer(("127.0.0.1", 0), _ZabbixHandler),
+        _ThreadingTCPServer(("127.0.0.1", 0), _TrapperHandler),
+    ]
+    conn.send([s.server_address[1] for s in servers] + [len(body)])
+    for s in servers[:-1]:
+        threading.Thread(target=s.serve_forever, daemon=True).start()
+    servers[-1].serve_forever()
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Runs the broker's cycle against the fakes and returns a results dict
+def run_benchmark(links, cycles=1):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(
+        target=_serve_fakes, args=(links, child_conn), daemon=True
+    )
+    fakes.start()
+    uisp_port, zabbix_port, trapper_port, body_bytes = parent_conn.recv()
+
+    try:
+        os.environ.update(
+            UISP_ENDPOINT=f"http://127.0.0.1:{uisp_port}",
+            UISP_AUTH_TOKEN="bench",
+            ZABBIX_URL=f"http://127.0.0.1:{zabbix_port}",
+            ZABBIX_UNAME="bench",
+            ZABBIX_PWORD="bench",
+        )
+        # Both link collectors, sharing the one /data-links download
+        os.environ.setdefault("COLLECTORS", "ptp,ptmp")
+
+        # Imported here so the fakes' process doesn't pay for them
+        from zappix.sender import Sender
+        import collectors
+        import main
+        import metrics
+        from pipeline import SenderWorker
+        from uisp_client import UISPClient
+        from zabbix_client import ZabbixClient
+
+        class Args:
+            update_templates = False
+            device_stats = False
+            derived = False
+            lld = False
+
+        uisp = UISPClient()
+        zapi = ZabbixClient()
+        enabled = collectors.from_env()
+        template_ids = main.bootstrap_templates(zapi, Args(), enabled)
+        engine = collectors.CollectionEngine(uisp, zapi, enabled, template_ids)
+        sender = SenderWorker(Sender("127.0.0.1", trapper_port))
+
+        stages = ("fetch", "filter", "build", "host_sync", "payload", "send")
+        results = []
+        for cycle in range(cycles):
+            before = {s: metrics.STAGE_SECONDS.sum(stage=s) for s in stages}
+            start = time.perf_counter()
+            payload = engine.collect(int(time.time()))
+            sender._send(payload)
+            elapsed = time.perf_counter() - start
+            results.append(
+                {
+                    "cycle": cycle,
+                    "seconds": round(elapsed, 3),
+                    "values": len(payload),
+                    "values_per_sec": round(len(payload) / elapsed),
+                    **{
+                        f"{s}_seconds": round(
+                            metrics.STAGE_SECONDS.sum(stage=s) - before[s], 3
+                        )
+                        for s in stages
+                    },
+                }
+            )
+        # Log out while the fake API is still there to answer
+        zapi._finalizer()
+        return {
+            "links": links,
+            "response_bytes": body_bytes,
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "cycles": results,
+        }
+    finally:
+        fakes.terminate()
+
+
+def _run_in_child(links, cycles, conn):
+    conn.send(run_benchmark(links, cycles))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark a full uisp2zabbix cycle offline.")
+    parser.add_argument(
+        "--links",
+        type=int,
+        nargs="+",
+        default=[1000],
+        help="Number of links in the synthetic /data-links payload (one run each)",
+    )
+    parser.add_argument("--cycles", type=int, default=2, help="Cycles per run")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    # Set up before main.py is imported, so its INFO logging stays quiet
+    logging.basicConfig(level=logging.WARNING)
+
+    # Each size runs in its own process so peak RSS isn't carried over
+    for links in args.links:
+        parent_conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(
+            target=_run_in_child, args=(links, args.cycles, child_conn)
+        )
+        p.start()
+        result = parent_conn.recv()
+        p.join()
+        if args.json:
+            print(json.dumps(result))
+            continue
+        print(
+            f"{result['links']} links, {result['response_bytes']} byte response, "
+            f"peak RSS {result['peak_rss_mb']} MB"
+        )
+        for c in result["cycles"]:
+            print(
+                f"  cycle {c['cycle']}: {c['seconds']}s, {c['values']} values, "
+                f"{c['values_per_sec']} values/s (fetch {c['fetch_seconds']}s, "
+                f"filter {c['filter_seconds']}s, build {c['build_seconds']}s, "
+                f"host_sync {c['host_sync_seconds']}s, "
+                f"payload {c['payload_seconds']}s, send {c['send_seconds']}s)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import time
+from typing import Callable
+
+from datalink import DataLink, PtMPLink
+import metrics
+import tracing
+from uisp_client import ChangeTracker, UISPClient
+from zappix.protocol import SenderData
+
+log = logging.getLogger("UISP2Zabbix")
+
+# Every collector that can be switched on, by name
+COLLECTORS = {}
+
+# What runs when COLLECTORS isn't set
+DEFAULT_COLLECTORS = ("ptp",)
+
+
+def register(cls):
+    missing = [a for a in Collector.__annotations__ if not hasattr(cls, a)]
+    if missing:
+        raise TypeError(f"Collector {cls.__name__} doesn't set {', '.join(missing)}")
+    COLLECTORS[cls.name] = cls
+    return cls
+
+
+# Turns the elements of one UISP endpoint into hosts of one kind. A
+# collector says which endpoint it reads, which elements it wants out of
+# it, and how to build a host (anything following HostProto) from one.
+# Collectors that read the same endpoint share a single download of it.
+class Collector:
+    name: str
+    endpoint: str
+    host_class: type
+    # Name the host for an element will have, used for sharding and change
+    # detection. Takes the slimmed element.
+    key: Callable[[dict], str]
+
+    def __init__(self, unchanged_max_age=300):
+        self.unchanged_max_age = unchanged_max_age
+
+    # Whether this collector wants the given element at all
+    def accepts(self, item):
+        return True
+
+    # Cuts an element down to the fields build() needs. Also what change
+    # detection hashes.
+    def slim(self, item):
+        return item
+
+    def build(self, item):
+        return self.host_class(item)
+
+    # Builds the trapper payload for a cycle's worth of hosts. Uses the
+    # host class' own payload() when it has one.
+    def payload(self, hosts, clock=None):
+        if hasattr(self.host_class, "payload"):
+            return self.host_class.payload(hosts, clock)
+        prefix = self.host_class.prefix
+        return [
+            SenderData(h.name, f"{prefix}.{k}", v, clock)
+            for h in hosts
+            for k, v in h.stats().items()
+        ]
+
+
+@register
+class PtPDataLinkCollector(Collector):
+    name = "ptp"
+    endpoint = "/data-links"
+    host_class = DataLink
+
+    def accepts(self, item):
+        return UISPClient._is_ptp_link(item)
+
+    def slim(self, item):
+        return UISPClient._slim_data_link(item)
+
+    key = staticmethod(DataLink.link_name)
+
+
+# Reads the same /data-links download as the PtP collector
+@register
+class PtMPDataLinkCollector(Collector):
+    name = "ptmp"
+    endpoint = "/data-links"
+    host_class = PtMPLink
+
+    def accepts(self, item):
+        return UISPClient._is_ptmp_link(item)
+
+    def slim(self, item):
+        return UISPClient._slim_data_link(item)
+
+    key = staticmethod(PtMPLink.link_name)
+
+
+# Picks the collectors named in the COLLECTORS env var (comma separated),
+# or DEFAULT_COLLECTORS if it's unset
+def from_env():
+    names = os.getenv("COLLECTORS", default="")
+    names = [n.strip() for n in names.split(",") if n.strip()] or list(
+        DEFAULT_COLLECTORS
+    )
+    unknown = [n for n in names if n not in COLLECTORS]
+    if unknown:
+        raise ValueError(f"Unknown collectors: {', '.join(unknown)}")
+    max_age = float(os.getenv("UISP_UNCHANGED_MAX_AGE", default=300))
+    return [COLLECTORS[n](max_age) for n in names]
+
+
+# Runs every collector once per cycle. Each endpoint is downloaded once
+# per UISP controller, with every controller and endpoint fetched
+# concurrently, and every element is handed to each collector that reads
+# that endpoint as it streams in. The hosts from all controllers and
+# collectors then go through host sync and into one payload.
+class CollectionEngine:
+    def __init__(
+        self,
+        uisp,
+        zapi,
+        collectors,
+        template_ids,
+        shard=None,
+        derived=None,
+        discovery=None,
+    ):
+        # One UISPClient, or a list of them
+        self.uisps = uisp if isinstance(uisp, list) else [uisp]
+        self.zapi = zapi
+        self.collectors = collectors
+        # Host class -> Zabbix template ID
+        self.template_ids = template_ids
+        self.shard = shard
+        # Optional extra stage that adds derived metrics for the hosts of
+        # one host class (see derived.py)
+        self.derived = derived
+        # Host class -> lld.Discovery, for host classes whose hosts Zabbix
+        # discovers instead of them being managed here
+        self.discovery = discovery or {}
+        # Future for (zapi, template_ids, discovery) while Zabbix is still
+        # being set up in the background (see defer_zabbix)
+        self._zabbix = None
+
+        self.by_endpoint = defaultdict(list)
+        for c in collectors:
+            self.by_endpoint[c.endpoint].append(c)
+        # Change detection state for each (controller, collector)
+        self._trackers = {
+            (u.name, c.name): ChangeTracker(c.unchanged_max_age)
+            for u in self.uisps
+            for c in collectors
+        }
+        self._pool = ThreadPoolExecutor(
+            max_workers=len(self.uisps) * len(self.by_endpoint),
+            thread_name_prefix="collect",
+        )
+
+    # For a fast start: Zabbix can still be being set up when the first
+    # cycle starts. The future's result (zapi, template_ids, discovery) is
+    # only waited on once the first fetch is done and hosts need syncing.
+    def defer_zabbix(self, future):
+        self._zabbix = future
+
+    def _wait_for_zabbix(self):
+        if self._zabbix is None:
+            return
+        with tracing.stage("zabbix_wait"):
+            zapi, template_ids, discovery = self._zabbix.result()
+        self.zapi = zapi
+        self.template_ids = template_ids
+        self.discovery = discovery or {}
+        self._zabbix = None
+
+    # Downloads one endpoint from one controller and builds hosts for every
+    # collector reading it. Returns a list of hosts per collector, how many
+    # elements ended up where, and the time spent filtering and building.
+    def _fetch(self, uisp, endpoint, changed_only):
+        collectors = self.by_endpoint[endpoint]
+        trackers = [self._trackers[(uisp.name, c.name)] for c in collectors]
+        hosts = {c: [] for c in collectors}
+        counts = defaultdict(int)
+        seconds = defaultdict(float)
+        for t in trackers:
+            t.begin()
+        for item in uisp.stream(endpoint, conditional=changed_only):
+            counts["received"] += 1
+            # Elements are only filtered out if no collector wanted them
+            accepted = False
+            for c, tracker in zip(collectors, trackers):
+                start = time.perf_counter()
+                slim = None
+                if c.accepts(item):
+                    accepted = True
+                    slim = c.slim(item)
+                    key = c.key(slim)
+                    if changed_only and not tracker.changed(key, slim):
+                        counts["unchanged"] += 1
+                        slim = None
+                    # Leave hosts owned by other shards to them
+                    elif self.shard is not None and not self.shard.owns(
+                        uisp.host_name(key)
+                    ):
+                        slim = None
+                build_start = time.perf_counter()
+                seconds["filter"] += build_start - start
+                if slim is None:
+                    continue
+                try:
+                    hosts[c].append(uisp.namespace(c.build(slim)))
+                except Exception as e:
+                    counts["failed"] += 1
+                    log.exception("Got exception processing %s payload: %s", c.name, e)
+                seconds["build"] += time.perf_counter() - build_start
+            if not accepted:
+                counts["filtered_out"] += 1
+
+        if uisp.last_status.get(endpoint) == 304:
+            return hosts, {"received": 0}, seconds
+        if changed_only:
+            # Forget elements that have gone away
+            for t in trackers:
+                t.end()
+        if counts["received"] == 0:
+            raise ValueError(f"Problem downloading UISP {endpoint}.")
+        return hosts, counts, seconds
+
+    # Runs one poll of UISP and builds the trapper payload for it, with
+    # every value stamped with the scheduler tick it was collected for
+    def collect(self, clock, update_hosts=False, changed_only=False, due=None):
+        cycle_start = time.time()
+        start = time.perf_counter()
+        futures = {
+            (u, e): self._pool.submit(self._fetch, u, e, changed_only)
+            for u in self.uisps
+            for e in self.by_endpoint
+        }
+        hosts = {}
+        counts = defaultdict(int)
+        seconds = defaultdict(float)
+        # Whether hosts has every host there is, rather than only the
+        # changed ones or those from the fetches that worked
+        complete = not changed_only
+        for (uisp, endpoint), future in futures.items():
+            try:
+                endpoint_hosts, endpoint_counts, endpoint_seconds = future.result()
+            except Exception as e:
+                log.exception(
+                    "Got exception querying UISP %s%s: %s",
+                    uisp.endpoint,
+                    endpoint,
+                    e,
+                )
+                complete = False
+                continue
+            for c, hs in endpoint_hosts.items():
+                hosts.setdefault(c, []).extend(hs)
+            for state, n in endpoint_counts.items():
+                counts[state] += n
+            for stage, s in endpoint_seconds.items():
+                seconds[stage] += s
+        if not hosts:
+            return []
+        if log.isEnabledFor(logging.DEBUG):
+            for u in self.uisps:
+                log.debug("UISP %s timings so far: %s", u.endpoint, u.timing_summary())
+        # Filtering and building happen as the responses stream in, so
+        # they're taken out of the fetch time. With several controllers
+        # they overlap, so this is only a rough split.
+        fetch_seconds = max(
+            time.perf_counter() - start - seconds["filter"] - seconds["build"], 0.0
+        )
+        tracing.observe("fetch", fetch_seconds, cycle_start)
+        tracing.observe("filter", seconds["filter"], cycle_start + fetch_seconds)
+        tracing.observe(
+            "build", seconds["build"], cycle_start + fetch_seconds + seconds["filter"]
+        )
+        for state in ("received", "filtered_out", "unchanged", "failed"):
+            metrics.LINKS.set(counts[state], state=state)
+        metrics.LINKS.set(sum(map(len, hosts.values())), state="built")
+
+        # Leave out hosts the adaptive scheduler says can wait. It's given
+        # every host at once, and told whether that's all of them, since it
+        # forgets the ones missing from a complete poll.
+        if due is not None:
+            kept = {
+                id(h)
+                for h in due([h for hs in hosts.values() for h in hs], clock, complete)
+            }
+            hosts = {c: [h for h in hs if id(h) in kept] for c, hs in hosts.items()}
+
+        self._wait_for_zabbix()
+
+        # Create any hosts that don't already exist (and fix drifted ones if
+        # asked to) in a handful of bulk calls. Hosts Zabbix wouldn't create
+        # are left out of the payload, since the trapper would only reject
+        # their values.
+        with tracing.stage("host_sync"):
+            for c, hs in hosts.items():
+                if c.host_class in self.discovery:
+                    continue
+                try:
+                    ids = self.zapi.sync_hosts(
+                        hs, self.template_ids[c.host_class], update=update_hosts
+                    )
+                    hosts[c] = [h for h in hs if h.name in ids]
+                except Exception as e:
+                    log.exception("Got exception syncing %s hosts: %s", c.name, e)
+
+        with tracing.stage("payload"):
+            payload = []
+            for c, hs in hosts.items():
+                p = c.payload(hs, clock)
+                discovery = self.discovery.get(c.host_class)
+                if discovery is not None:
+                    p = discovery.inventory(hs, clock) + discovery.rewrite(p)
+                payload += p
+
+        if self.derived is not None:
+            with tracing.stage("derive"):
+                try:
+                    p = self.derived.payload(
+                        [
+                            h
+                            for c, hs in hosts.items()
+                            if c.host_class is self.derived.host_class
+                            for h in hs
+                        ],
+                        clock,
+                    )
+                    discovery = self.discovery.get(self.derived.host_class)
+                    payload += p if discovery is None else discovery.rewrite(p)
+                except Exception as e:
+                    log.exception("Got exception computing derived metrics: %s", e)
+
+        # One line per cycle, rather than one per host
+        built = sum(map(len, hosts.values()))
+        log.info(
+            "Cycle %s: %s received, %s built, %s failed, %s values in %.3fs",
+            clock,
+            counts["received"],
+            built,
+            counts["failed"],
+            len(payload),
+            time.perf_counter() - start,
+            extra={
+                "fields": {
+                    "event": "cycle",
+                    "clock": clock,
+                    **counts,
+                    "built": built,
+                    "values": len(payload),
+                    "seconds": round(time.perf_counter() - start, 3),
+                }
+            },
+        )
+        return payload
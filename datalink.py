@@ -2,10 +2,13 @@ from dataclasses import dataclass
 import dataclasses
 from typing import Protocol
 
+from zappix.protocol import SenderData
 from zabbix_client import NUMERIC_FLOAT, NUMERIC_UNSIGNED, TEXT, TemplateItem
 
 
 class HostProto(Protocol):
+    __slots__ = ()
+
     name: str
     tags: dict
     prefix: str
@@ -34,7 +37,7 @@ class HostProto(Protocol):
 # Becuase there's a pretty high chance we might not care. Maybe if we add routers.
 
 
-@dataclass
+@dataclass(slots=True)
 class DataLinkStatistics:
     rxRate: int
     txRate: int
@@ -69,54 +72,104 @@ class DataLinkDeviceID:
     authorized: bool
 
 
+# Field order of DataLinkStatistics, worked out once
+STATISTICS_FIELDS = tuple(f.name for f in dataclasses.fields(DataLinkStatistics))
+
+
 class DataLink(HostProto):
+    # A DataLink is kept as a flat tuple of values in the order of
+    # stat_names/keys below, rather than a dict or a pair of dataclasses,
+    # since one of these is built for every link on every poll.
+    __slots__ = ("name", "tags", "values")
+
     name: str
     tags: dict
-    signal: int
-    frequency: int
-    from_stats: DataLinkStatistics
-    to_stats: DataLinkStatistics
+    values: tuple
     prefix = "uisp2zabbix.p2p"
 
+    # Names of the values, as used in stats(), and their full item keys
+    stat_names = (
+        ("signal", "frequency")
+        + tuple(f"from_{f}" for f in STATISTICS_FIELDS)
+        + tuple(f"to_{f}" for f in STATISTICS_FIELDS)
+    )
+    keys = tuple(map(f"{prefix}.".__add__, stat_names))
+    # Keys of tags, as set in __init__
+    tag_names = ("from", "to", "from_dev", "to_dev")
+
+    # For the adaptive scheduler: a link is polled at the fastest rate while
+    # any of these move by more than the given amount between polls...
+    volatile_fields = {
+        "from_linkScore": 0.05,
+        "to_linkScore": 0.05,
+        "from_signalLocal": 2,
+        "to_signalLocal": 2,
+    }
+    # ...or any of these are above the given level
+    busy_fields = {
+        "from_downlinkUtilization": 0.8,
+        "to_downlinkUtilization": 0.8,
+    }
+
     # Use the JSON blob to set up the DataLink object
     def __init__(self, link_json):
-        self.name = link_json["ssid"].strip()
-        self.signal = link_json["signal"]
-        self.frequency = link_json["frequency"]
+        self.name = self.link_name(link_json)
         self.tags = {
             "from": link_json["from"]["site"]["identification"]["name"],
             "to": link_json["to"]["site"]["identification"]["name"],
             "from_dev": link_json["from"]["device"]["identification"]["model"],
             "to_dev": link_json["to"]["device"]["identification"]["model"],
         }
-        self.from_stats = DataLinkStatistics(
-            **link_json["from"]["interface"]["statistics"]
+        from_stats = link_json["from"]["interface"]["statistics"]
+        to_stats = link_json["to"]["interface"]["statistics"]
+        self.values = (
+            # Send top-level signal number
+            link_json["signal"],
+            # Send top-level frequency, multiplied by a million
+            # to get it into Hz so that Zabbix's units work without
+            # pre-processing.
+            link_json["frequency"] * 1000000,
+            *(from_stats[f] for f in STATISTICS_FIELDS),
+            *(to_stats[f] for f in STATISTICS_FIELDS),
         )
-        self.to_stats = DataLinkStatistics(**link_json["to"]["interface"]["statistics"])
 
-    def stats(self):
-        stats = {}
-        
-        # Send top-level signal number
-        stats["signal"] = self.signal
+    # Name of the host for a link
+    @staticmethod
+    def link_name(link_json):
+        return link_json["ssid"].strip()
 
-        # Send top-level frequency, multiplied by a million
-        # to get it into Hz so that Zabbix's units work without
-        # pre-processing.
-        stats["frequency"] = self.frequency * 1000000
+    @property
+    def signal(self):
+        return self.values[0]
 
-        # Send from stats
-        for k, v in self.from_stats.__dict__.items():
-            stats[f"from_{k}"] = v
+    @property
+    def frequency(self):
+        return self.values[1] // 1000000
 
-        # Send to stats
-        for k, v in self.to_stats.__dict__.items():
-            stats[f"to_{k}"] = v
+    @property
+    def from_stats(self):
+        return DataLinkStatistics(*self.values[2 : 2 + len(STATISTICS_FIELDS)])
 
-        return stats
+    @property
+    def to_stats(self):
+        return DataLinkStatistics(*self.values[2 + len(STATISTICS_FIELDS) :])
 
-    @staticmethod
-    def build_template():
+    def stats(self):
+        return dict(zip(self.stat_names, self.values))
+
+    # Builds the trapper payload for a whole cycle's worth of links in one
+    # pass, straight from each link's values and the precomputed keys
+    @classmethod
+    def payload(cls, links, clock=None):
+        keys = cls.keys
+        return [
+            SenderData(l.name, k, v, clock)
+            for l in links
+            for k, v in zip(keys, l.values)
+        ]
+
+    @classmethod
+    def build_template(cls):
         # Set up the items in the new template
         items = []
 
@@ -124,7 +177,7 @@ class DataLink(HostProto):
         items.append(
             TemplateItem(
                 "signal",
-                f"{DataLink.prefix}.signal",
+                f"{cls.prefix}.signal",
                 NUMERIC_FLOAT,
                 "dB",
             )
@@ -134,7 +187,7 @@ class DataLink(HostProto):
         items.append(
             TemplateItem(
                 "frequency",
-                f"{DataLink.prefix}.frequency",
+                f"{cls.prefix}.frequency",
                 NUMERIC_UNSIGNED,
                 "Hz",
             )
@@ -157,9 +210,29 @@ class DataLink(HostProto):
                 items.append(
                     TemplateItem(
                         f"{direction}_{field.name}",
-                        f"{DataLink.prefix}.{direction}_{field.name}",
+                        f"{cls.prefix}.{direction}_{field.name}",
                         t,
                         u,
                     )
                 )
         return items
+
+
+# One station's link to its access point on a PtMP sector. UISP reports
+# these with the same statistics as PtP links, but the sector's SSID is
+# shared by all of its stations, so each link is named after its station.
+# The name gets a "ptmp." prefix so that it isn't the same host as the
+# station's own Device (--device-stats).
+class PtMPLink(DataLink):
+    __slots__ = ()
+
+    prefix = "uisp2zabbix.ptmp"
+    keys = tuple(map(f"{prefix}.".__add__, DataLink.stat_names))
+
+    # Named after the station end of the link
+    @staticmethod
+    def link_name(link_json):
+        station = link_json["to"]
+        if link_json["from"]["device"]["overview"]["wirelessMode"] == "sta-ptmp":
+            station = link_json["from"]
+        return "ptmp." + station["device"]["identification"]["name"].strip()
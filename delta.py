@@ -0,0 +1,56 @@
+import logging
+import time
+
+log = logging.getLogger("UISP2Zabbix")
+
+
+# Change detection between DataLink.stats() and the trapper. Remembers the
+# last value sent for every (host, key) and drops values that haven't
+# changed, or have moved by no more than the deadband, unless the last send
+# for that item is more than heartbeat seconds old. Values are compared to
+# the last value actually sent, so slow drift still gets through once it
+# adds up to more than the deadband.
+class DeltaFilter:
+    def __init__(self, deadband=0.0, heartbeat=300):
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        # (host, key) -> (value, clock) of the last value let through
+        self.last_sent = {}
+
+        # Running totals, for logging/monitoring
+        self.sent = 0
+        self.suppressed = 0
+
+    def _unchanged(self, old, new):
+        if isinstance(old, bool) or isinstance(new, bool):
+            return old == new
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+            return abs(new - old) <= self.deadband
+        return old == new
+
+    # Returns the subset of the SenderData list that should be sent
+    def filter(self, payload):
+        now = time.time()
+        out = []
+        for d in payload:
+            clock = d.clock if d.clock is not None else now
+            last = self.last_sent.get((d.host, d.key))
+            if (
+                last is not None
+                and clock - last[1] < self.heartbeat
+                and self._unchanged(last[0], d.value)
+            ):
+                continue
+            self.last_sent[(d.host, d.key)] = (d.value, clock)
+            out.append(d)
+
+        self.sent += len(out)
+        self.suppressed += len(payload) - len(out)
+        log.info(
+            "Delta filter: sending %s of %s values (%s sent, %s suppressed in total)",
+            len(out),
+            len(payload),
+            self.sent,
+            self.suppressed,
+        )
+        return out
@@ -0,0 +1,164 @@
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+from datalink import DataLink
+from zabbix_client import NUMERIC_FLOAT, TemplateItem
+from zappix.protocol import SenderData
+
+# DataLink values the derived metrics are worked out from
+SOURCE_FIELDS = tuple(
+    f"{d}_{f}"
+    for d in ("from", "to")
+    for f in (
+        "signalLocal",
+        "signalChain0",
+        "signalChain1",
+        "linkScore",
+        "downlinkUtilization",
+        "downlinkCapacity",
+        "uplinkCapacity",
+        "theoreticalDownlinkCapacity",
+        "theoreticalUplinkCapacity",
+    )
+)
+
+# Values that get a rolling average over the last few cycles
+ROLLING_FIELDS = (
+    "from_signalLocal",
+    "to_signalLocal",
+    "from_linkScore",
+    "to_linkScore",
+    "from_downlinkUtilization",
+    "to_downlinkUtilization",
+)
+
+# Derived metrics sent for every link, and the units for their template
+# items
+DERIVED_METRICS = {
+    # Difference between the two receive chains. A big one usually means a
+    # bad cable or connector on one polarity.
+    "from_chainImbalance": "dB",
+    "to_chainImbalance": "dB",
+    # Capacity as a share of what the link could do at its current width
+    "from_downlinkCapacityRatio": "%",
+    "from_uplinkCapacityRatio": "%",
+    "to_downlinkCapacityRatio": "%",
+    "to_uplinkCapacityRatio": "%",
+    # How differently the two ends see the link
+    "signalAsymmetry": "dB",
+    "capacityAsymmetry": "%",
+    **{f"{f}Avg": "dB" if "signal" in f else "" for f in ROLLING_FIELDS},
+}
+
+
+# Works out derived metrics for a whole cycle's worth of DataLinks at once.
+# The links are loaded into a table and every metric is computed column by
+# column. Rolling averages come from a ring buffer of the last `window`
+# cycles, with one row per link; links that haven't been seen for a whole
+# window are dropped from it.
+class DerivedMetrics:
+    host_class = DataLink
+
+    def __init__(self, window=6):
+        self.window = window
+        # Link name -> row in history
+        self._rows = {}
+        # cycle slot x link row x ROLLING_FIELDS
+        self._history = np.full((window, 0, len(ROLLING_FIELDS)), np.nan)
+        self._cycle = 0
+        self._source = itemgetter(*map(DataLink.stat_names.index, SOURCE_FIELDS))
+
+    def _table(self, links):
+        df = pd.DataFrame.from_records(
+            [self._source(l.values) for l in links],
+            columns=SOURCE_FIELDS,
+            index=[l.name for l in links],
+        )
+        # UISP leaves some of these empty (e.g. the second chain on
+        # single-chain radios)
+        return df.apply(pd.to_numeric, errors="coerce")
+
+    # Drops links whose history is all gaps
+    def _compact(self):
+        live = ~np.isnan(self._history).all(axis=(0, 2))
+        names = [n for n, row in self._rows.items() if live[row]]
+        self._history = self._history[:, [self._rows[n] for n in names]]
+        self._rows = {n: i for i, n in enumerate(names)}
+
+    # Records this cycle's values and returns the average over the window
+    # for each link, in the order of df
+    def _roll(self, df):
+        if self._cycle % self.window == 0:
+            self._compact()
+        rows = np.fromiter(
+            (self._rows.setdefault(n, len(self._rows)) for n in df.index),
+            dtype=np.intp,
+            count=len(df),
+        )
+        if len(self._rows) > self._history.shape[1]:
+            grown = np.full(
+                (self.window, len(self._rows) * 2, len(ROLLING_FIELDS)), np.nan
+            )
+            grown[:, : self._history.shape[1]] = self._history
+            self._history = grown
+
+        slot = self._cycle % self.window
+        self._cycle += 1
+        self._history[slot] = np.nan
+        self._history[slot, rows] = df[list(ROLLING_FIELDS)].to_numpy(float)
+
+        h = self._history[:, rows]
+        count = (~np.isnan(h)).sum(axis=0)
+        return np.nansum(h, axis=0) / np.where(count, count, np.nan)
+
+    # Returns a table of DERIVED_METRICS, indexed by link name
+    def compute(self, links):
+        df = self._table(links)
+        out = pd.DataFrame(index=df.index)
+        for d in ("from", "to"):
+            out[f"{d}_chainImbalance"] = (
+                df[f"{d}_signalChain0"] - df[f"{d}_signalChain1"]
+            ).abs()
+            for direction, theoretical in (
+                ("downlink", "theoreticalDownlink"),
+                ("uplink", "theoreticalUplink"),
+            ):
+                out[f"{d}_{direction}CapacityRatio"] = (
+                    df[f"{d}_{direction}Capacity"]
+                    / df[f"{d}_{theoretical}Capacity"].replace(0, np.nan)
+                    * 100
+                )
+        out["signalAsymmetry"] = df["from_signalLocal"] - df["to_signalLocal"]
+        capacity = df[["from_downlinkCapacity", "to_downlinkCapacity"]]
+        out["capacityAsymmetry"] = (
+            (capacity["from_downlinkCapacity"] - capacity["to_downlinkCapacity"])
+            / capacity.max(axis=1).replace(0, np.nan)
+            * 100
+        )
+        rolling = self._roll(df)
+        for i, f in enumerate(ROLLING_FIELDS):
+            out[f"{f}Avg"] = rolling[:, i]
+        return out
+
+    # Builds the trapper payload for the derived metrics, leaving out any
+    # that couldn't be worked out (missing values, zero capacity)
+    def payload(self, links, clock=None):
+        if not links:
+            return []
+        out = self.compute(links)
+        keys = [f"{DataLink.prefix}.{c}" for c in out.columns]
+        return [
+            SenderData(name, k, v, clock)
+            for name, row in zip(out.index, out.to_numpy().tolist())
+            for k, v in zip(keys, row)
+            if v == v
+        ]
+
+    @staticmethod
+    def build_template():
+        return [
+            TemplateItem(name, f"{DataLink.prefix}.{name}", NUMERIC_FLOAT, unit)
+            for name, unit in DERIVED_METRICS.items()
+        ]
@@ -0,0 +1,53 @@
+from datalink import HostProto
+from zabbix_client import NUMERIC_FLOAT, TemplateItem
+
+# Time series from /devices/{id}/statistics that get forwarded to Zabbix,
+# and the units for their template items
+DEVICE_STATISTICS = {
+    "cpu": "%",
+    "ram": "%",
+    "ping": "ms",
+    "signal": "dB",
+    "remoteSignal": "dB",
+    "downlinkCapacity": "bps",
+    "uplinkCapacity": "bps",
+    "linkScore": "",
+}
+
+
+class Device(HostProto):
+    name: str
+    tags: dict
+    id: str
+    # Statistic name -> list of (timestamp in ms, value)
+    series: dict
+    prefix = "uisp2zabbix.device"
+
+    # Use the /devices JSON blob to set up the Device object
+    def __init__(self, device_json):
+        identification = device_json["identification"]
+        self.id = identification["id"]
+        self.name = identification["name"].strip()
+        self.tags = {
+            "model": identification.get("model") or "",
+            "role": identification.get("role") or "",
+            "site": (identification.get("site") or {}).get("name") or "",
+        }
+        self.series = {}
+
+    # Latest value of each statistic
+    def stats(self):
+        return {k: points[-1][1] for k, points in self.series.items() if points}
+
+    # Every point from the last statistics fetch, as (key, timestamp in ms, value)
+    def points(self):
+        for k, points in self.series.items():
+            for x, y in points:
+                yield (k, x, y)
+
+    @staticmethod
+    def build_template():
+        return [
+            TemplateItem(name, f"{Device.prefix}.{name}", NUMERIC_FLOAT, unit)
+            for name, unit in DEVICE_STATISTICS.items()
+        ]
@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import threading
+import time
+
+from device import DEVICE_STATISTICS, Device
+
+log = logging.getLogger("UISP2Zabbix")
+
+
+# Spaces out requests to a single host so that no more than `rate` of them
+# start per second, however many threads are asking
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+# Fans /devices/{id}/statistics out across every device UISP knows about
+# with a bounded thread pool. Each device only asks for the window since the
+# newest point we already have for it, so repeated collections only pick up
+# new points.
+class DeviceStatsCollector:
+    def __init__(self, uisp, workers=8, rate=20, timeout=10, lookback=60, shard=None):
+        self.uisp = uisp
+        self.shard = shard
+        self.workers = workers
+        self.timeout = timeout
+        self.lookback = lookback
+        self.rate_limiter = RateLimiter(rate)
+        # Device ID -> timestamp (ms) of the newest point collected
+        self.last_fetch = {}
+
+    # Returns the devices that were fetched successfully, with their new
+    # points in Device.series, and the device ID -> timestamp of the newest
+    # point for each. The next collection only starts after those once
+    # they've been passed to commit(), which should be left until the points
+    # have been handed off, so none are skipped if sending them fails.
+    def collect(self):
+        devices = []
+        for d in self.uisp.get_devices():
+            try:
+                device = self.uisp.namespace(Device(d))
+                if self.shard is None or self.shard.owns(device.name):
+                    devices.append(device)
+            except Exception as e:
+                log.exception("Got exception processing UISP device: %s", e)
+
+        now_ms = int(time.time() * 1000)
+        collected = []
+        newest = {}
+        failed = 0
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="stats") as pool:
+            futures = {pool.submit(self._fetch, d, now_ms): d for d in devices}
+            for future in as_completed(futures):
+                try:
+                    x = future.result()
+                    collected.append(futures[future])
+                    if x is not None:
+                        newest[futures[future].id] = x
+                except Exception as e:
+                    failed += 1
+                    log.warning(
+                        "Couldn't fetch statistics for %s: %s", futures[future].name, e
+                    )
+
+        log.info(
+            "Fetched statistics for %s devices (%s failed)", len(collected), failed
+        )
+        return collected, newest
+
+    def commit(self, newest):
+        self.last_fetch.update(newest)
+
+    def _fetch(self, device, now_ms):
+        since = self.last_fetch.get(device.id)
+        start = now_ms - self.lookback * 1000 if since is None else since + 1
+
+        self.rate_limiter.wait()
+        history = self.uisp.get_stats(
+            device.id, start=start, period=max(now_ms - start, 1), timeout=self.timeout
+        )
+
+        newest = since
+        for name in DEVICE_STATISTICS:
+            points = []
+            for p in history.get(name) or []:
+                x, y = p.get("x"), p.get("y")
+                if x is None or x < start or not isinstance(y, (int, float)):
+                    continue
+                points.append((x, y))
+                newest = x if newest is None else max(newest, x)
+            if points:
+                device.series[name] = sorted(points)
+
+        return newest
@@ -0,0 +1,77 @@
+import fcntl
+import logging
+import os
+import socket
+import time
+
+from metrics import LEADER
+
+log = logging.getLogger("UISP2Zabbix")
+
+
+# Leader election between redundant brokers, through an exclusive lock on a
+# file they can all see (a bind-mounted or shared volume). Whichever holds
+# the lock polls and sends; the rest stand by. The lock goes away with the
+# leader's process, so a standby picks it up on its next try without any
+# lease to expire.
+class LeaderLock:
+    def __init__(self, path):
+        self.path = path
+        self.identity = f"{socket.gethostname()}:{os.getpid()}"
+        self._fd = None
+
+    @property
+    def is_leader(self):
+        return self._fd is not None
+
+    # Takes the lock if nobody else holds it. Returns whether this instance
+    # is the leader.
+    def try_acquire(self):
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        # Leave a note of who holds it, for whoever's looking
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{self.identity}\n".encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    # Who holds the lock, going by the note they left
+    def holder(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    # Blocks until this instance is the leader, checking the lock every
+    # `check` seconds. While standing by, runs on_standby (e.g. to keep
+    # caches warm) every interval seconds.
+    def wait(self, interval, on_standby=None, check=1.0):
+        LEADER.set(0)
+        next_standby = 0.0
+        while not self.try_acquire():
+            now = time.monotonic()
+            if now >= next_standby:
+                log.info("Standing by, %s is the leader", self.holder())
+                if on_standby is not None:
+                    try:
+                        on_standby()
+                    except Exception as e:
+                        log.exception("Got exception while standing by: %s", e)
+                next_standby = now + interval
+            time.sleep(check)
+        LEADER.set(1)
+        log.info("Took the leader lock %s as %s", self.path, self.identity)
@@ -0,0 +1,156 @@
+import json
+import logging
+from types import SimpleNamespace
+import time
+
+from zabbix_client import TemplateItem
+from zappix.protocol import SenderData
+
+log = logging.getLogger("UISP2Zabbix")
+
+# What a discovery rule's prototypes create: a host per discovered entity,
+# linked to the host class' regular template, or an item per value on the
+# discovery host itself
+PROTOTYPE_MODES = ("hosts", "items")
+
+
+def _macro(name):
+    return "{#" + name.upper() + "}"
+
+
+# Quotes a value for use as an item key parameter
+def _key_param(value):
+    return '"' + value.replace('"', '\\"') + '"'
+
+
+# Low-level discovery in place of managing a Zabbix host per entity over
+# the API. The broker owns a single discovery host and sends it the
+# inventory as one LLD JSON value, and Zabbix creates (and eventually
+# removes) hosts or items from the prototypes on the discovery template.
+# Everything after setup goes through the trapper.
+#
+# The inventory is resent when it changes, or every `interval` seconds
+# otherwise. Entities drop out of it once they haven't been seen for
+# `interval` seconds, so cycles that only carry some of the entities
+# (--changed-only, --adaptive) don't make the rest disappear.
+class Discovery:
+    def __init__(self, host_class, host, prototypes="hosts", interval=3600):
+        if prototypes not in PROTOTYPE_MODES:
+            raise ValueError(f"LLD prototypes must be one of {PROTOTYPE_MODES}")
+        self.host_class = host_class
+        # Name of the discovery host
+        self.host = host
+        self.prototypes = prototypes
+        self.interval = interval
+        self.key = self.rule_key(host_class)
+
+        # Entity name -> (LLD macros, when it was last seen)
+        self._inventory = {}
+        self._sent = None
+        self._last_send = 0.0
+
+    @staticmethod
+    def rule_key(host_class):
+        return f"{host_class.prefix}.discovery"
+
+    @staticmethod
+    def template_name(host_class):
+        return f"{host_class.__name__} discovery by UISPZabbix"
+
+    # Item prototypes on the discovery host, one per template item, with
+    # the entity name as a key parameter
+    @staticmethod
+    def item_prototypes(items):
+        return [
+            TemplateItem(
+                f"{i.name} of {{#NAME}}",
+                f"{i.key}[{_key_param('{#NAME}')}]",
+                i.value_type,
+                i.unit,
+            )
+            for i in items
+        ]
+
+    # Sets up the discovery template for a host class: the trapper
+    # discovery rule and its prototypes. items are the template items the
+    # host class has (see main.template_items), and tag_names the tags
+    # discovered hosts get (the host class' tag_names by default).
+    # Returns: (template_id, created)
+    @classmethod
+    def setup(
+        cls,
+        zapi,
+        host_class,
+        items,
+        host_template_id,
+        prototypes,
+        sync=False,
+        tag_names=None,
+    ):
+        template_id, created = zapi.get_or_create_template(
+            host_class, template_name=cls.template_name(host_class)
+        )
+        if not (created or sync):
+            return template_id, created
+
+        rule_id = zapi.get_or_create_discovery_rule(
+            template_id, cls.rule_key(host_class), f"{host_class.__name__} discovery"
+        )
+        if tag_names is None:
+            tag_names = getattr(host_class, "tag_names", ())
+        if prototypes == "hosts":
+            zapi.sync_host_prototype(
+                rule_id,
+                _macro("name"),
+                host_template_id,
+                tags={t: _macro(t) for t in tag_names},
+            )
+        else:
+            zapi.sync_template_items(
+                template_id, cls.item_prototypes(items), rule_id=rule_id
+            )
+        return template_id, created
+
+    # Makes sure the discovery host exists and has the discovery template
+    def attach(self, zapi, template_id):
+        zapi.sync_hosts([SimpleNamespace(name=self.host, tags={})], template_id)
+
+    def _macros(self, host):
+        return {
+            _macro("name"): host.name,
+            **{_macro(k): v for k, v in host.tags.items()},
+        }
+
+    # Adds this cycle's hosts to the inventory. Returns the LLD value to
+    # send, if it's due.
+    def inventory(self, hosts, clock=None):
+        now = time.time()
+        for h in hosts:
+            self._inventory[h.name] = (self._macros(h), now)
+        for name in [
+            n for n, (_, seen) in self._inventory.items() if now - seen > self.interval
+        ]:
+            del self._inventory[name]
+
+        current = {n: m for n, (m, _) in self._inventory.items()}
+        if current == self._sent and now - self._last_send < self.interval:
+            return []
+        self._sent = current
+        self._last_send = now
+        log.info("Sending LLD inventory of %s entities to %s", len(current), self.host)
+        return [
+            SenderData(self.host, self.key, json.dumps(list(current.values())), clock)
+        ]
+
+    # Points values at wherever the prototypes put them. Discovered hosts
+    # keep their names and keys; discovered items live on the discovery
+    # host, keyed by entity name.
+    def rewrite(self, payload):
+        if self.prototypes == "hosts":
+            return payload
+        return [
+            SenderData(
+                self.host, f"{d.key}[{_key_param(d.host)}]", d.value, d.clock, d.ns
+            )
+            for d in payload
+        ]
@@ -1,15 +1,29 @@
+import time
+
+# When the broker started, for reporting the time to its first sent value
+STARTED = time.time()
+
 from argparse import ArgumentParser
-import dataclasses
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 import os
-import time
 import json
+import multiprocessing
+import threading
 from dotenv import load_dotenv
-from datalink import DataLinkStatistics, DataLink
+import collectors
+from collectors import CollectionEngine
+import metrics
+from pipeline import AdaptiveScheduler, Scheduler, SenderWorker
+from sharding import Shard
+from spool import Spool
+import tracing
 from uisp_client import UISPClient
 from zabbix_client import ZabbixClient
-from zappix.sender import Sender
-from zappix.protocol import SenderData
+
+# Everything else (the trapper sender, pandas, and the modules behind
+# optional flags) is imported where it's used, so startup and --dump
+# only pay for what they need
 
 if not os.path.exists("./log"):
     os.mkdir("./log")
@@ -41,74 +55,409 @@ def main():
         help="Force updating hosts",
     )
 
+    parser.add_argument(
+        "--device-stats",
+        action="store_true",
+        help="Also forward per-device statistics from /devices/{id}/statistics",
+    )
+
+    parser.add_argument(
+        "--suppress-unchanged",
+        action="store_true",
+        help="Only send data link values that changed, plus a periodic heartbeat",
+    )
+
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="Only process data links whose UISP statistics changed since the last poll",
+    )
+
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Poll busy or changing links more often and stable ones less often",
+    )
+
+    parser.add_argument(
+        "--derived",
+        action="store_true",
+        help="Also send derived link metrics (chain imbalance, capacity ratios, rolling averages)",
+    )
+
+    parser.add_argument(
+        "--ha",
+        action="store_true",
+        help="Run as one of several redundant brokers; only the one holding HA_LOCK_FILE polls",
+    )
+
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write per-cycle tracing spans as JSON to TRACE_DIR",
+    )
+
+    parser.add_argument(
+        "--lld",
+        action="store_true",
+        help="Send the link inventory to a trapper discovery rule and let Zabbix create the hosts",
+    )
+
+    parser.add_argument(
+        "--fast-start",
+        action="store_true",
+        help="Poll UISP straight away and set up Zabbix in the background meanwhile",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Split the links across this many local worker processes",
+    )
+
     args = parser.parse_args()
 
     load_dotenv()
-    uisp = UISPClient()
+    tracing.configure_logging()
 
     if args.dump:
-        print(json.dumps(uisp.get_data_links(filter=True), indent=2))
+        for uisp in UISPClient.from_env():
+            print(json.dumps(uisp.get_data_links(filter=True), indent=2))
         return
 
-    # For talking to the Zabbix API. Also creates Default Template Group and
-    # Default Host Group
-    zapi = ZabbixClient()
-
-    # Set up template for DataLinks (if needed)
-    datalink_template_id, created = zapi.get_or_create_template(DataLink)
-    if created or args.update_templates:
-        for item in DataLink.build_template():
-            zapi.get_or_create_template_item(
-                datalink_template_id,
-                item.name,
-                item.key,
-                item.value_type,
-                item.unit,
-                update=True,
-            )
+    if args.workers > 1:
+        run_workers(args, args.workers)
+    else:
+        run(args, Shard.from_env())
+
+
+# Finds (or creates) the templates this run needs, and brings their items
+# up to date when they're new or --update-templates is set. Returns the
+# template ID for each host class.
+def bootstrap_templates(zapi, args, enabled, sync_templates=True):
+    host_classes = list(dict.fromkeys(c.host_class for c in enabled))
+    if args.device_stats:
+        from device import Device
+
+        host_classes.append(Device)
+
+    template_ids = {}
+    for host_class in host_classes:
+        template_id, created = zapi.get_or_create_template(host_class)
+        if sync_templates and (created or args.update_templates):
+            zapi.sync_template_items(template_id, template_items(host_class))
+        template_ids[host_class] = template_id
+
+    if args.lld:
+        bootstrap_discovery(zapi, args, enabled, template_ids, sync_templates)
+
+    return template_ids
+
+
+# The items a host class' template should have
+def template_items(host_class):
+    items = host_class.build_template()
+    # Derived metrics live on the template of the hosts they're worked out
+    # for. Their items are there whether or not --derived is on, so that an
+    # --update-templates run without it doesn't delete them (and their
+    # history). This only runs when templates are synced or --lld makes
+    # item prototypes, so those are the only times pandas gets imported.
+    from derived import DerivedMetrics
+
+    if host_class is DerivedMetrics.host_class:
+        items += DerivedMetrics.build_template()
+    return items
+
+
+# Sets up a discovery template for each host class the collectors build,
+# for --lld. Returns the discovery template ID for each host class.
+def bootstrap_discovery(zapi, args, enabled, template_ids, sync_templates=True):
+    from lld import Discovery
+
+    prototypes = os.getenv("LLD_PROTOTYPES", default="hosts")
+    # Hosts from named controllers are tagged with the controller's name
+    # (see UISPClient.namespace), and discovered ones should be too
+    controller_tag = ("controller",) if os.getenv("UISP_CONTROLLERS") else ()
+    discovery_ids = {}
+    for host_class in dict.fromkeys(c.host_class for c in enabled):
+        discovery_ids[host_class], _ = Discovery.setup(
+            zapi,
+            host_class,
+            # Only item prototypes are made from these
+            template_items(host_class) if prototypes == "items" else [],
+            template_ids[host_class],
+            prototypes,
+            sync=sync_templates and args.update_templates,
+            tag_names=getattr(host_class, "tag_names", ()) + controller_tag,
+        )
+    return discovery_ids
+
+
+# Runs one local shard per worker process. Templates are set up once here
+# first, so the workers don't all race to create them.
+def run_workers(args, workers):
+    bootstrap_templates(ZabbixClient(), args, collectors.from_env())
+
+    shard_ids = [str(i) for i in range(workers)]
+    processes = [
+        multiprocessing.Process(
+            target=run,
+            args=(args, Shard(shard_id, shard_ids), False),
+            name=f"shard-{shard_id}",
+        )
+        for shard_id in shard_ids
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+
+def run(args, shard=None, sync_templates=True):
+    if shard is not None:
+        log.info("Running as shard %s", shard)
+
+    if args.trace:
+        tracing.TRACER.enable(os.getenv("TRACE_DIR", default="./log"))
+
+    # Optional self-instrumentation endpoint. Local workers each get their
+    # own port, counting up from METRICS_PORT.
+    # Blank in .env.sample, which sets it to "" rather than leaving it unset
+    metrics_port = int(os.getenv("METRICS_PORT") or 0)
+    if metrics_port:
+        if args.workers > 1 and shard is not None:
+            metrics_port += shard.shard_ids.index(shard.id)
+        metrics.serve(metrics_port)
+
+    # Every UISP controller is polled by this one broker, each with its
+    # own connection pool
+    uisp = UISPClient.from_env()
+
+    enabled = collectors.from_env()
+    derived = None
+    if args.derived:
+        from derived import DerivedMetrics
+
+        derived = DerivedMetrics(window=int(os.getenv("DERIVED_WINDOW", default=6)))
+
+    # Zabbix login and template setup normally happen before the first
+    # poll. With --fast-start they run in the background while the first
+    # poll is already fetching from UISP, and the first cycle only waits on
+    # them once it needs to sync hosts.
+    engine = CollectionEngine(uisp, None, enabled, None, shard, derived)
+    if args.fast_start:
+        pool = ThreadPoolExecutor(1, thread_name_prefix="zabbix-bootstrap")
+        zabbix = pool.submit(connect_zabbix, args, shard, enabled, sync_templates)
+        pool.shutdown(wait=False)
+    else:
+        zabbix = Future()
+        zabbix.set_result(connect_zabbix(args, shard, enabled, sync_templates))
+    engine.defer_zabbix(zabbix)
+
+    sleep_duration = int(os.getenv("SLEEP_DURATION", default=10))
+    metrics.POLL_INTERVAL_SECONDS.set(sleep_duration)
+
+    # In HA mode, stand by here until this instance holds the leader lock,
+    # keeping the host cache warm so that taking over doesn't mean looking
+    # up every host again. Everything from here on (sending, spool replay,
+    # device stats) only runs on the leader.
+    leader = None
+    metrics.LEADER.set(1)
+    if args.ha:
+        lock_path = os.getenv("HA_LOCK_FILE", default="./log/leader.lock")
+        if shard is not None:
+            lock_path = f"{lock_path}.shard-{shard.id}"
+        from leader import LeaderLock
+
+        leader = LeaderLock(lock_path)
+        leader.wait(
+            sleep_duration,
+            on_standby=lambda: warm_cache(*zabbix.result()[:2]),
+        )
 
     # For pushing data to Zabbix (doing the actual broker-ing)
+    from zappix.sender import Sender
+
     z_endpoint = os.getenv("ZABBIX_ENDPOINT")
     if not z_endpoint:
         raise ValueError("Must provide Zabbix endpoint")
     z_sender = Sender(z_endpoint)
 
-    while True:
-        z_payload = []
-        logging.info("Querying UISP for Data Link info...")
-        for l in uisp.get_data_links(filter=True):
-            try:
-                p2p = DataLink(l)
-
-                # Create the host if it doesn't already exist
-                zapi.get_or_create_host(
-                    p2p, datalink_template_id, update=args.update_hosts
-                )
-
-                for k, v in p2p.stats().items():
-                    z_payload.append(SenderData(p2p.name, f"{DataLink.prefix}.{k}", v))
-            except Exception as e:
-                log.exception(f"Got exception processing UISP payload: {e}")
-
-        # Send collected payloads to Zabbix
-        log.info("Sending collected metrics to Zabbix...")
-        attempts_left = 2
-        while attempts_left > 0:
-            try:
-                z_sender.send_bulk(z_payload, with_timestamps=True)
-                break
-            except Exception as e:
-                attempts_left -= 1
-                logging.exception(e)
-                logging.error("Sleeping for 3 seconds and trying again.")
-                time.sleep(3)
+    # Values that can't be delivered are spooled to disk and replayed once
+    # the trapper is back. Each shard keeps its own spool.
+    spool = None
+    spool_max_bytes = int(os.getenv("SPOOL_MAX_BYTES", default=100 * 1024 * 1024))
+    if spool_max_bytes > 0:
+        spool_dir = os.getenv("SPOOL_DIR", default="./log/spool")
+        if shard is not None:
+            spool_dir = os.path.join(spool_dir, f"shard-{shard.id}")
+        spool = Spool(spool_dir, max_bytes=spool_max_bytes)
+
+    # Hand collected payloads off to a background sender so that slow
+    # trapper sends don't push back the next UISP poll
+    sender = SenderWorker(
+        z_sender,
+        maxsize=int(os.getenv("SENDER_QUEUE_SIZE", default=2)),
+        attempts=int(os.getenv("SENDER_ATTEMPTS", default=3)),
+        chunk_size=int(os.getenv("SENDER_CHUNK_SIZE", default=1000)),
+        connections=int(os.getenv("SENDER_CONNECTIONS", default=4)),
+        spool=spool,
+        replay_rate=int(os.getenv("SPOOL_REPLAY_RATE", default=1000)),
+        started=STARTED,
+    )
+    sender.start()
+
+    # Device statistics run on their own schedule, since fetching them for
+    # every device takes a lot longer than one /data-links poll. Each
+    # controller gets its own collector.
+    if args.device_stats:
+        from device_stats import DeviceStatsCollector
+
+        for u in uisp:
+            collector = DeviceStatsCollector(
+                u,
+                workers=int(os.getenv("DEVICE_STATS_WORKERS", default=8)),
+                rate=float(os.getenv("DEVICE_STATS_RATE", default=20)),
+                timeout=float(os.getenv("DEVICE_STATS_TIMEOUT", default=10)),
+                lookback=int(os.getenv("DEVICE_STATS_INTERVAL", default=60)),
+                shard=shard,
+            )
+            threading.Thread(
+                target=poll_device_stats,
+                args=(collector, zabbix, sender),
+                name=f"device-stats-{u.name}" if u.name else "device-stats",
+                daemon=True,
+            ).start()
+
+    delta = None
+    if args.suppress_unchanged:
+        from delta import DeltaFilter
+
+        delta = DeltaFilter(
+            deadband=float(os.getenv("DELTA_DEADBAND", default=0)),
+            heartbeat=int(os.getenv("DELTA_HEARTBEAT", default=300)),
+        )
+
+    # The trapper rejects values for hosts that don't exist, so if it starts
+    # doing that, recheck the host cache
+    rejected = 0
+
+    if args.adaptive:
+        scheduler = AdaptiveScheduler(
+            sleep_duration,
+            int(os.getenv("POLL_MAX_INTERVAL", default=60)),
+            immediate=args.fast_start,
+        )
+        log.info(
+            "Polling UISP every %s-%ss per link...",
+            sleep_duration,
+            scheduler.max_interval,
+        )
+    else:
+        scheduler = Scheduler(sleep_duration, immediate=args.fast_start)
+        log.info("Polling UISP every %ss...", sleep_duration)
+
+    for tick in scheduler.ticks():
+        z_payload = engine.collect(
+            int(tick),
+            args.update_hosts,
+            # A forced host update needs to see every link
+            args.changed_only and not args.update_hosts,
+            scheduler.due if args.adaptive and not args.update_hosts else None,
+        )
+        if delta is not None:
+            z_payload = delta.filter(z_payload)
+        sender.submit(z_payload)
+        metrics.CYCLE_SECONDS.set(time.time() - tick)
+        tracing.TRACER.flush()
+
+        # Rejects can come in before the engine has picked up zapi (e.g.
+        # for device stats, if the first polls all failed)
+        if sender.failed > rejected and zabbix.done():
+            rejected = sender.failed
+            zabbix.result()[0].validate_cache_in_background()
 
         if args.update_hosts or args.update_templates:
-            return
-        # Sleep until it's time to gather more data
-        sleep_duration = os.getenv("SLEEP_DURATION", default=10)
-        log.info(f"Sleeping for {sleep_duration}s...")
-        time.sleep(int(sleep_duration))
+            break
+
+    sender.close()
+
+
+# Logs into Zabbix and sets up everything the collectors need there.
+# Returns (zapi, template_ids, discovery), as CollectionEngine.defer_zabbix
+# expects.
+def connect_zabbix(args, shard, enabled, sync_templates=True):
+    start = time.perf_counter()
+
+    # For talking to the Zabbix API. Also creates Default Template Group and
+    # Default Host Group. Host and template IDs are kept on disk between
+    # runs; each shard keeps its own file.
+    cache_path = os.getenv("ZABBIX_CACHE_FILE", default="./log/zabbix_cache.json")
+    if cache_path and shard is not None:
+        cache_path = f"{cache_path}.shard-{shard.id}"
+    zapi = ZabbixClient(cache_path=cache_path or None)
+    # Cached hosts are trusted until this says otherwise
+    zapi.validate_cache_in_background()
+
+    template_ids = bootstrap_templates(zapi, args, enabled, sync_templates)
+
+    # With --lld, the collectors' hosts are left to Zabbix to discover, and
+    # the broker only manages one discovery host per host class (and shard)
+    discovery = None
+    if args.lld:
+        from lld import Discovery
+
+        prefix = os.getenv("LLD_HOST_PREFIX", default="UISP2Zabbix")
+        if shard is not None:
+            prefix = f"{prefix} {shard.id}"
+        discovery = {}
+        for host_class, template_id in bootstrap_discovery(
+            zapi, args, enabled, template_ids, False
+        ).items():
+            discovery[host_class] = Discovery(
+                host_class,
+                f"{prefix} {host_class.__name__} discovery",
+                prototypes=os.getenv("LLD_PROTOTYPES", default="hosts"),
+                interval=int(os.getenv("LLD_INTERVAL", default=3600)),
+            )
+            discovery[host_class].attach(zapi, template_id)
+
+    log.info("Zabbix set up in %.2fs", time.perf_counter() - start)
+    return zapi, template_ids, discovery
+
+
+# What a standby instance does between lock checks in HA mode
+def warm_cache(zapi, template_ids):
+    zapi.warm_cache(template_ids.values())
+
+
+def poll_device_stats(collector, zabbix, sender):
+    from device import Device
+    from zappix.protocol import SenderData
+
+    zapi, template_ids, _ = zabbix.result()
+    template_id = template_ids[Device]
+    interval = int(os.getenv("DEVICE_STATS_INTERVAL", default=60))
+    for _ in Scheduler(interval).ticks():
+        try:
+            devices, newest = collector.collect()
+            # Devices Zabbix wouldn't create a host for are left out
+            ids = zapi.sync_hosts(devices, template_id)
+            devices = [d for d in devices if d.name in ids]
+        except Exception as e:
+            log.exception("Got exception collecting device statistics: %s", e)
+            continue
+
+        # Points keep the timestamps UISP recorded them at
+        z_payload = [
+            SenderData(d.name, f"{Device.prefix}.{k}", v, x // 1000, x % 1000 * 1000000)
+            for d in devices
+            for k, x, v in d.points()
+        ]
+        if z_payload:
+            sender.submit(z_payload)
+        collector.commit(newest)
 
 
 if __name__ == "__main__":
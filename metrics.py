@@ -0,0 +1,225 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger("UISP2Zabbix")
+
+# Every metric defined in this process, in definition order
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+# Minimal Prometheus-style metrics, so the broker can describe itself
+# without pulling in a client library. Metrics are cheap to update whether
+# or not anything ever scrapes them.
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {labels}")
+        return tuple(labels[n] for n in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines += self._render_sample(key, value)
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    # Total of all observed values so far
+    def sum(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, (None, 0.0))[1]
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        lines = [
+            f"{self.name}_bucket"
+            f"{_format_labels(self.labels, key, [('le', _format_value(bound))])} {count}"
+            for bound, count in zip(self.buckets, counts)
+        ]
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total!r}")
+        lines.append(
+            f"{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}"
+        )
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves /metrics on the given port from a background thread
+def serve(port, address=""):
+    server = ThreadingHTTPServer((address, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Serving metrics on port %s", port)
+    return server
+
+
+# Metrics for each stage of the broker
+UISP_REQUEST_SECONDS = Histogram(
+    "uisp2zabbix_uisp_request_seconds",
+    "Time taken by UISP API requests, including reading the body",
+    ["endpoint", "controller"],
+)
+UISP_CONNECT_SECONDS = Counter(
+    "uisp2zabbix_uisp_connect_seconds_total",
+    "Time spent opening TCP/TLS connections to UISP",
+    ["endpoint", "controller"],
+)
+UISP_RESPONSE_BYTES = Counter(
+    "uisp2zabbix_uisp_response_bytes_total",
+    "Bytes read from UISP responses, as sent on the wire",
+    ["endpoint", "controller"],
+)
+STAGE_SECONDS = Histogram(
+    "uisp2zabbix_stage_seconds",
+    "Time taken by each stage of a poll cycle",
+    ["stage"],
+)
+LINKS = Gauge(
+    "uisp2zabbix_links",
+    "Data links in the last poll, by what happened to them",
+    ["state"],
+)
+ZABBIX_API_CALLS = Counter(
+    "uisp2zabbix_zabbix_api_calls_total",
+    "Zabbix API requests made, by method",
+    ["method"],
+)
+HOST_CACHE_LOOKUPS = Counter(
+    "uisp2zabbix_host_cache_lookups_total",
+    "Host lookups answered from host_cache versus the Zabbix API",
+    ["result"],
+)
+TRAPPER_VALUES = Counter(
+    "uisp2zabbix_trapper_values_total",
+    "Values sent to the Zabbix trapper, by outcome",
+    ["result"],
+)
+CYCLE_SECONDS = Gauge(
+    "uisp2zabbix_cycle_seconds",
+    "How long the last poll cycle took",
+)
+POLL_INTERVAL_SECONDS = Gauge(
+    "uisp2zabbix_poll_interval_seconds",
+    "The configured poll interval",
+)
+CYCLE_OVERRUNS = Counter(
+    "uisp2zabbix_cycle_overruns_total",
+    "Poll cycles that ran past the next scheduled tick",
+)
+SKIPPED_TICKS = Counter(
+    "uisp2zabbix_skipped_ticks_total",
+    "Scheduled polls skipped because the previous cycle overran",
+)
+LEADER = Gauge(
+    "uisp2zabbix_leader",
+    "1 if this instance holds the HA leader lock (or isn't running in HA mode)",
+)
+ZABBIX_API_CACHE = Counter(
+    "uisp2zabbix_zabbix_api_cache_total",
+    "Zabbix API reads answered from the response cache, merged into another "
+    "in-flight read, or sent",
+    ["result"],
+)
+STARTUP_SECONDS = Gauge(
+    "uisp2zabbix_startup_seconds",
+    "Time from the broker starting to its first values being accepted by Zabbix",
+)
@@ -0,0 +1,330 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import math
+import queue
+import random
+import threading
+import time
+
+from metrics import (
+    CYCLE_OVERRUNS,
+    LINKS,
+    SKIPPED_TICKS,
+    STARTUP_SECONDS,
+    TRAPPER_VALUES,
+)
+import tracing
+
+log = logging.getLogger("UISP2Zabbix")
+
+
+# Fixed-rate scheduler. Ticks land on wall-clock multiples of the interval
+# (e.g. :00, :10, :20 for a 10 second interval) no matter how long each
+# cycle takes, so the timestamps we stamp on item values stay evenly spaced.
+# If a cycle runs past one or more ticks, those ticks are skipped rather
+# than fired back to back. With immediate=True, the first tick fires
+# straight away instead of waiting for the next aligned one.
+class Scheduler:
+    def __init__(self, interval, immediate=False):
+        if interval <= 0:
+            raise ValueError("Scheduler interval must be positive.")
+        self.interval = interval
+        self.immediate = immediate
+
+    # Index of the first aligned tick at or after the given time
+    def _index(self, now):
+        return math.ceil(now / self.interval)
+
+    def ticks(self):
+        if self.immediate:
+            yield time.time()
+        n = self._index(time.time())
+        while True:
+            tick = n * self.interval
+            delay = tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            yield tick
+
+            n += 1
+            now = time.time()
+            overrun = now - n * self.interval
+            if overrun > 0:
+                skipped = self._index(now) - n
+                CYCLE_OVERRUNS.inc()
+                SKIPPED_TICKS.inc(skipped)
+                log.warning(
+                    "Cycle overran its %ss interval by %.1fs, skipping %s tick(s)",
+                    self.interval,
+                    overrun,
+                    skipped,
+                )
+                n += skipped
+
+
+# Scheduler that polls each link at its own rate, between min_interval and
+# max_interval. Ticks still land on wall-clock multiples of min_interval
+# (so elapsed processing time is taken out of each wait), but ticks where no
+# known link is due are skipped without polling UISP at all. A link drops to
+# min_interval as soon as one of its volatile_fields moves by more than the
+# given amount since it was last sent, or one of its busy_fields goes over
+# the given level, and doubles its interval each time it is seen stable, up
+# to max_interval.
+class AdaptiveScheduler(Scheduler):
+    def __init__(self, min_interval, max_interval, immediate=False):
+        super().__init__(min_interval, immediate)
+        self.max_interval = max(max_interval, min_interval)
+        # Link name -> [interval, next due time, last watched values]
+        self.links = {}
+        # Host class -> how to read its watched values (see _watch)
+        self._watches = {}
+
+    def ticks(self):
+        for tick in super().ticks():
+            if self.links and tick < min(s[1] for s in self.links.values()):
+                continue
+            yield tick
+
+    # Works out, once per host class, how to read the busy_fields and
+    # volatile_fields of a link as one tuple. Hosts that keep their values
+    # in a flat tuple (like DataLink) are read by index rather than through
+    # stats(), which builds a dict of every value.
+    # Returns: (getter, [(position, level)], [(position, delta)])
+    def _watch(self, cls):
+        watch = self._watches.get(cls)
+        if watch is None:
+            busy = getattr(cls, "busy_fields", {})
+            volatile = getattr(cls, "volatile_fields", {})
+            fields = (*busy, *volatile)
+            if hasattr(cls, "stat_names"):
+                indices = [cls.stat_names.index(f) for f in fields]
+
+                def getter(link):
+                    return tuple(link.values[i] for i in indices)
+
+            else:
+
+                def getter(link):
+                    stats = link.stats()
+                    return tuple(stats.get(f) for f in fields)
+
+            watch = self._watches[cls] = (
+                getter,
+                list(enumerate(busy.values())),
+                list(enumerate(volatile.values(), len(busy))),
+            )
+        return watch
+
+    @staticmethod
+    def _volatile(watched, previous, busy, volatile):
+        for i, level in busy:
+            if (watched[i] or 0) > level:
+                return True
+        for i, delta in volatile:
+            old, new = previous[i], watched[i]
+            if old is not None and new is not None and abs(new - old) > delta:
+                return True
+        return False
+
+    # Returns the links that are due at this tick and works out when each of
+    # them is next due. Every fetched link is checked, so one that starts
+    # moving is picked up straight away rather than when it was next due.
+    # complete says links holds every link there is (a full, successful
+    # poll), so the ones missing from it have gone away. Otherwise (e.g.
+    # --changed-only, or a failed fetch) missing links are kept as they are.
+    def due(self, links, tick, complete=True):
+        due = []
+        seen = set()
+        for link in links:
+            seen.add(link.name)
+            state = self.links.get(link.name)
+            getter, busy, volatile = self._watch(type(link))
+            watched = getter(link)
+            if state is None or self._volatile(watched, state[2], busy, volatile):
+                interval = self.interval
+            elif tick >= state[1]:
+                interval = min(state[0] * 2, self.max_interval)
+            else:
+                continue
+            self.links[link.name] = [interval, tick + interval, watched]
+            due.append(link)
+
+        # Forget links that have gone away
+        if complete:
+            for name in self.links.keys() - seen:
+                del self.links[name]
+
+        LINKS.set(len(links) - len(due), state="not_due")
+        return due
+
+
+# Background thread that drains collected payloads into the Zabbix trapper,
+# so the next UISP poll can start while the previous batch is still being
+# sent. The queue is bounded: if the sender falls behind, submit() blocks,
+# which holds up the producer and makes the scheduler skip ticks instead of
+# piling up unsent batches in memory.
+#
+# Each payload is split into chunks that go out over several trapper
+# connections at once. Only chunks whose send fails (connection errors or a
+# non-success reply) are retried, with jittered exponential backoff. Values
+# the trapper rejects (the "failed" count in its reply) are counted but not
+# retried, since resending them won't change the outcome. With a spool,
+# values that still couldn't be delivered are written to disk and replayed
+# at replay_rate values per second when the sender is otherwise idle.
+class SenderWorker(threading.Thread):
+    def __init__(
+        self,
+        sender,
+        maxsize=2,
+        attempts=3,
+        retry_delay=3,
+        chunk_size=1000,
+        connections=4,
+        spool=None,
+        replay_rate=1000,
+        started=None,
+    ):
+        super().__init__(name="zabbix-sender", daemon=True)
+        # When the broker started (time.time()), for reporting how long it
+        # took to get the first values into Zabbix
+        self.started = started
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.sender = sender
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=maxsize)
+        # Running total of values the trapper rejected
+        self.failed = 0
+        self._pool = ThreadPoolExecutor(connections, thread_name_prefix="trapper")
+
+    def submit(self, payload):
+        if self.queue.full():
+            log.warning("Sender queue is full, waiting for it to drain...")
+        self.queue.put(payload)
+
+    # Send whatever is still queued, then stop the thread
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self._pool.shutdown()
+
+    def run(self):
+        while True:
+            # While there's a spooled backlog, wake up once a second to
+            # replay a slice of it whenever no live data is waiting
+            timeout = 1 if self.spool is not None and self.spool.pending() else None
+            try:
+                payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._replay()
+                continue
+
+            try:
+                if payload is None:
+                    return
+                undelivered = self._send(payload)
+                if undelivered and self.spool is not None:
+                    self.spool.append(undelivered)
+            except Exception as e:
+                log.exception("Got exception sending to Zabbix: %s", e)
+            finally:
+                self.queue.task_done()
+
+    # Replays up to replay_rate spooled values, oldest first. Chunks that
+    # went through are committed straight away, so they aren't sent (and
+    # stored by Zabbix) twice; the rest stay in the spool for the next try.
+    def _replay(self):
+        try:
+            values = self.spool.peek(self.replay_rate)
+            if not values:
+                return
+            log.info("Replaying %s spooled values...", len(values))
+            undelivered = self._send(values)
+            self.spool.commit(len(values), keep=undelivered)
+        except Exception as e:
+            log.exception("Got exception replaying spool: %s", e)
+
+    def _send_chunk(self, chunk):
+        info = self.sender.send_bulk(chunk, with_timestamps=True)
+        if info.response != "success":
+            raise ValueError(f"Trapper replied {info.response!r}")
+        return info
+
+    # Sends one payload and returns the values that couldn't be delivered
+    def _send(self, payload):
+        start = time.perf_counter()
+        chunks = [
+            payload[i : i + self.chunk_size]
+            for i in range(0, len(payload), self.chunk_size)
+        ]
+        log.debug("Sending %s values in %s chunks...", len(payload), len(chunks))
+
+        processed = failed = total = retried = 0
+        pending = list(range(len(chunks)))
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                delay = self.retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                log.warning("Retrying %s chunks in %.1fs...", len(pending), delay)
+                time.sleep(delay)
+                retried += len(pending)
+
+            futures = {
+                self._pool.submit(self._send_chunk, chunks[i]): i for i in pending
+            }
+            pending = []
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    info = future.result()
+                except Exception as e:
+                    log.warning("Chunk %s (%s values) failed: %s", i, len(chunks[i]), e)
+                    pending.append(i)
+                    continue
+                processed += info.processed
+                failed += info.failed
+                total += info.total
+
+            if not pending:
+                break
+
+        undelivered = [d for i in sorted(pending) for d in chunks[i]]
+        seconds = time.perf_counter() - start
+        tracing.observe("send", seconds, values=len(payload))
+        TRAPPER_VALUES.inc(processed, result="processed")
+        TRAPPER_VALUES.inc(failed, result="failed")
+        if self.started is not None and processed:
+            startup = time.time() - self.started
+            self.started = None
+            STARTUP_SECONDS.set(startup)
+            log.info(
+                "First values delivered %.2fs after start",
+                startup,
+                extra={"fields": {"event": "startup", "seconds": round(startup, 3)}},
+            )
+        self.failed += failed
+        TRAPPER_VALUES.inc(len(undelivered), result="undelivered")
+        log.info(
+            "Sent %s values: %s processed, %s failed, %s undelivered in %.3fs",
+            len(payload),
+            processed,
+            failed,
+            len(undelivered),
+            seconds,
+            extra={
+                "fields": {
+                    "event": "send",
+                    "values": len(payload),
+                    "chunks": len(chunks),
+                    "chunks_retried": retried,
+                    "chunks_dropped": len(pending),
+                    "processed": processed,
+                    "failed": failed,
+                    "total": total,
+                    "undelivered": len(undelivered),
+                    "seconds": round(seconds, 3),
+                }
+            },
+        )
+        return undelivered
@@ -0,0 +1,43 @@
+import hashlib
+import os
+
+
+# Rendezvous (highest random weight) hashing: every key goes to the shard
+# with the highest hash of (shard, key). Adding or removing a shard only
+# moves the keys that shard gains or loses, about 1/N of them, and every
+# instance works out the same owner without talking to the others.
+def _weight(shard_id, key):
+    digest = hashlib.blake2b(f"{shard_id}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def owner(key, shard_ids):
+    return max(shard_ids, key=lambda shard_id: _weight(shard_id, key))
+
+
+class Shard:
+    def __init__(self, shard_id, shard_ids):
+        self.id = str(shard_id)
+        self.shard_ids = tuple(str(s) for s in shard_ids)
+        if self.id not in self.shard_ids:
+            raise ValueError(f"Shard '{self.id}' is not in {self.shard_ids}.")
+
+    def __str__(self):
+        return f"{self.id} of {','.join(self.shard_ids)}"
+
+    # Whether this shard is responsible for the given key (a link SSID or
+    # device name)
+    def owns(self, key):
+        return owner(key, self.shard_ids) == self.id
+
+    # Reads SHARD_ID and SHARD_IDS (comma separated). Returns None when
+    # sharding isn't configured.
+    @staticmethod
+    def from_env():
+        shard_id = os.getenv("SHARD_ID")
+        shard_ids = os.getenv("SHARD_IDS")
+        if not shard_id and not shard_ids:
+            return None
+        if not shard_id or not shard_ids:
+            raise ValueError("SHARD_ID and SHARD_IDS must be set together.")
+        return Shard(shard_id, [s.strip() for s in shard_ids.split(",") if s.strip()])
@@ -0,0 +1,154 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from zappix.protocol import SenderData
+
+log = logging.getLogger("UISP2Zabbix")
+
+SEGMENT_SUFFIX = ".spool"
+
+
+# Durable, append-only spool for values the trapper couldn't take. Values
+# are appended as JSON lines to numbered segment files in a directory (by
+# default under the ./log volume, so they survive container restarts).
+# Once the total size passes max_bytes, whole segments are evicted oldest
+# first. Replay works on the oldest segment: it is loaded, sorted by
+# timestamp and handed out in batches; delivered values are committed by
+# rewriting the segment with whatever is left, and the segment is removed
+# once it is empty.
+#
+# Timestamp order only holds within a segment. Segments are replayed in the
+# order they were written, which is close to timestamp order since values
+# are spooled as they fail, but values spooled late with older timestamps
+# (e.g. device stats, which look back over DEVICE_STATS_INTERVAL) can come
+# after newer ones from the segment before. Zabbix stores each value at its
+# own timestamp either way; merging every segment would mean holding up to
+# max_bytes of values in memory.
+class Spool:
+    def __init__(
+        self, directory, max_bytes=100 * 1024 * 1024, segment_bytes=1024 * 1024
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        self._next_seq = self._seq(segments[-1]) + 1 if segments else 0
+        self._current = None
+        # Sorted values from the segment being replayed, and its path
+        self._replaying = None
+        self._replaying_path = None
+
+        if segments:
+            log.info("Found %s spooled segments in %s", len(segments), directory)
+
+    @staticmethod
+    def _seq(path):
+        return int(os.path.basename(path)[: -len(SEGMENT_SUFFIX)])
+
+    def _segments(self):
+        return sorted(
+            glob.glob(os.path.join(self.directory, f"*{SEGMENT_SUFFIX}")),
+            key=self._seq,
+        )
+
+    def _new_segment(self):
+        path = os.path.join(self.directory, f"{self._next_seq:012d}{SEGMENT_SUFFIX}")
+        self._next_seq += 1
+        return path
+
+    @staticmethod
+    def _encode(d, now):
+        clock = d.clock if d.clock is not None else int(now)
+        return json.dumps([d.host, d.key, d.value, clock, d.ns]) + "\n"
+
+    def size(self):
+        return sum(os.path.getsize(p) for p in self._segments())
+
+    def pending(self):
+        with self._lock:
+            return bool(self._replaying) or bool(self._segments())
+
+    def append(self, values):
+        if not values:
+            return
+        now = time.time()
+        with self._lock:
+            if (
+                self._current is None
+                or os.path.getsize(self._current) >= self.segment_bytes
+            ):
+                self._current = self._new_segment()
+            with open(self._current, "a", encoding="utf-8") as f:
+                f.writelines(self._encode(d, now) for d in values)
+                f.flush()
+                os.fsync(f.fileno())
+            log.warning(
+                "Spooled %s undelivered values to %s", len(values), self._current
+            )
+            self._evict()
+
+    def _evict(self):
+        segments = self._segments()
+        total = sum(os.path.getsize(p) for p in segments)
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = segments.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            log.warning("Spool is over %s bytes, evicted %s", self.max_bytes, oldest)
+            if oldest == self._replaying_path:
+                self._replaying = None
+                self._replaying_path = None
+
+    # Returns up to limit of the oldest spooled values, in timestamp order.
+    # They stay in the spool until commit() is called with the same count.
+    def peek(self, limit):
+        with self._lock:
+            if not self._replaying:
+                segments = self._segments()
+                if not segments:
+                    return []
+                path = segments[0]
+                # Start a fresh segment for appends so this one is left alone
+                if path == self._current:
+                    self._current = None
+                values = []
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            values.append(SenderData(*json.loads(line)))
+                        except ValueError:
+                            log.warning("Skipping corrupt line in %s", path)
+                values.sort(key=lambda d: (d.clock, d.ns or 0))
+                self._replaying = values
+                self._replaying_path = path
+                if not values:
+                    os.remove(path)
+                    self._replaying_path = None
+                    return []
+            return self._replaying[:limit]
+
+    # Drops the first count values handed out by peek(), apart from those
+    # in keep (the ones that weren't delivered), which stay at the front
+    def commit(self, count, keep=()):
+        with self._lock:
+            if not self._replaying:
+                return
+            self._replaying = list(keep) + self._replaying[count:]
+            path = self._replaying_path
+            if not self._replaying:
+                os.remove(path)
+                self._replaying_path = None
+                return
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(self._encode(d, 0) for d in self._replaying)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
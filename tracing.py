@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import STAGE_SECONDS
+
+log = logging.getLogger("UISP2Zabbix")
+
+
+# Formats log records as one JSON object per line. Structured fields go in
+# through extra={"fields": {...}}, and end up as top-level keys.
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Sets up the root logger from LOG_LEVEL and LOG_FORMAT ("text" or "json")
+def configure_logging():
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", default="INFO").upper())
+    if os.getenv("LOG_FORMAT", default="text") == "json":
+        for handler in root.handlers:
+            handler.setFormatter(JsonFormatter())
+
+
+# Records spans for the stages of each cycle and writes them out in the
+# Chrome trace event format, which chrome://tracing and Perfetto can open.
+# Spans are buffered in memory and appended to the file once per cycle by
+# flush(). Does nothing until enable() is called.
+class Tracer:
+    def __init__(self):
+        self.path = None
+        self._events = []
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def enable(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(
+            directory, f"trace-{os.getpid()}-{int(time.time())}.json"
+        )
+        # The closing bracket is optional in this format, so events can
+        # just keep being appended
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("[\n")
+        log.info("Writing trace spans to %s", self.path)
+
+    # Records a span that started at the given wall clock time
+    def record(self, name, start, seconds, **attrs):
+        if self.path is None:
+            return
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int(seconds * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.current_thread().name,
+            "args": attrs,
+        }
+        with self._lock:
+            self._events.append(event)
+
+    def flush(self):
+        if self.path is None:
+            return
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(e) + ",\n" for e in events)
+        except OSError as e:
+            log.warning("Couldn't write trace spans to %s: %s", self.path, e)
+
+
+TRACER = Tracer()
+
+
+# Times a stage of the cycle into STAGE_SECONDS, and as a trace span when
+# tracing is on
+@contextmanager
+def stage(name, **attrs):
+    start = time.time()
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t, start, **attrs)
+
+
+# Same as stage(), for time that was added up across a loop
+def observe(name, seconds, start=None, **attrs):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    TRACER.record(
+        name, time.time() - seconds if start is None else start, seconds, **attrs
+    )
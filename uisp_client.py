@@ -1,49 +1,338 @@
+import codecs
+import hashlib
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
 import os
+import re
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.request import ACCEPT_ENCODING
 import json
 
+from metrics import (
+    UISP_CONNECT_SECONDS,
+    UISP_REQUEST_SECONDS,
+    UISP_RESPONSE_BYTES,
+)
+
+# Size of the chunks read off the socket when streaming a response
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_ARRAY_SEPARATORS = re.compile(r"[\s,]*")
+_ELEMENT_ENDS = frozenset(",] \t\r\n")
+
+
+# Incrementally parses a top-level JSON array from an iterable of byte
+# chunks, yielding each element as soon as it has been fully received, so
+# only one element (plus the unparsed tail of the buffer) is held at a time.
+def _iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        pos = _ARRAY_SEPARATORS.match(buf, pos).end()
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Expected a JSON array from UISP.")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Most likely the element just hasn't fully arrived yet
+                if eof:
+                    raise
+            else:
+                # A number that reaches the end of the buffer (or stops
+                # partway through an exponent) might go on in the next
+                # chunk, so elements are only taken once the separator or
+                # closing bracket after them has arrived
+                if eof or (end < len(buf) and buf[end] in _ELEMENT_ENDS):
+                    pos = end
+                    yield element
+                    continue
+
+        if eof:
+            raise ValueError("UISP response ended before the JSON array did.")
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf = buf[pos:] + text_decoder.decode(b"", final=True)
+        else:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+
+# Time spent opening connections (TCP + TLS handshake) by the current
+# thread, so it can be split out of each request's timing
+_connect_timer = threading.local()
+
+
+class _TimedConnectMixin:
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_timer.seconds += time.perf_counter() - start
+            _connect_timer.count += 1
+
+
+class _TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+# Running totals for one UISP endpoint. connect is TCP + TLS setup for new
+# connections, wait is the rest of the time until the response headers
+# arrive, and transfer is the time spent reading the body.
+@dataclass
+class EndpointTiming:
+    requests: int = 0
+    connections: int = 0
+    connect_seconds: float = 0.0
+    wait_seconds: float = 0.0
+    transfer_seconds: float = 0.0
+    bytes: int = 0
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests, {self.connections} new connections, "
+            f"connect {self.connect_seconds:.2f}s, wait {self.wait_seconds:.2f}s, "
+            f"transfer {self.transfer_seconds:.2f}s, {self.bytes} bytes"
+        )
+
+
+# Remembers a hash of every item seen on the last poll, and when it was
+# last passed on, so unchanged items can be skipped. Unchanged items are
+# still passed on once they're max_age seconds old, so they never go stale
+# in Zabbix. Call begin() before each poll and end() after it; items not
+# seen in between are forgotten.
+class ChangeTracker:
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._hashes = {}
+        self._next = {}
+        self._now = 0.0
+
+    def begin(self, now=None):
+        self._now = time.time() if now is None else now
+        self._next = {}
+
+    def end(self):
+        self._hashes = self._next
+
+    def changed(self, key, item):
+        digest = hashlib.blake2b(
+            json.dumps(item, separators=(",", ":")).encode(), digest_size=16
+        ).digest()
+        previous = self._hashes.get(key)
+        if (
+            key is not None
+            and previous is not None
+            and previous[0] == digest
+            and self._now - previous[1] < self.max_age
+        ):
+            self._next[key] = previous
+            return False
+        self._next[key] = (digest, self._now)
+        return True
+
 
 class UISPClient:
-    def __init__(self):
-        self.headers = {"x-auth-token": os.getenv("UISP_AUTH_TOKEN")}
-        self.endpoint = os.getenv("UISP_ENDPOINT")
+    # With a name, the client is one of several UISP controllers polled by
+    # the same broker. Its settings come from UISP_<NAME>_* env vars (e.g.
+    # UISP_EAST_ENDPOINT), and the hosts built from it are namespaced by
+    # name (see namespace()). Tunables fall back to the plain UISP_* ones,
+    # but the endpoint and token don't, so a forgotten one can't end up
+    # polling the default controller twice.
+    def __init__(self, name=None):
+        self.name = name
+        self.endpoint = self._env("ENDPOINT", fallback=False)
+        self.headers = {"x-auth-token": self._env("AUTH_TOKEN", fallback=False)}
 
-        if not self.endpoint or not self.headers:
-            raise ValueError("Missing environment variables.")
+        for key, value in (
+            ("ENDPOINT", self.endpoint),
+            ("AUTH_TOKEN", self.headers["x-auth-token"]),
+        ):
+            if not value:
+                raise ValueError(f"Missing environment variable {self._var(key)}.")
 
-    def get_devices(self):
-        response = requests.get(
-            f"{self.endpoint}/devices", headers=self.headers, verify=False
+        self.timeout = (
+            float(self._env("CONNECT_TIMEOUT", 5)),
+            float(self._env("READ_TIMEOUT", 30)),
         )
 
-        devices = json.loads(response.content)
+        # One pooled, keep-alive session for the life of the client, so
+        # connections are reused across requests and poll cycles
+        pool_size = int(self._env("POOL_SIZE", 10))
+        adapter = _TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers)
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        self.session.verify = False
+
+        self.timings = defaultdict(EndpointTiming)
+
+        # State for changed-only polling. Validators (ETag, Last-Modified,
+        # time fetched) from the last full response for each path, and the
+        # status of the last response for each path. Conditional requests
+        # stop once the last full response is unchanged_max_age seconds old.
+        self.unchanged_max_age = float(self._env("UNCHANGED_MAX_AGE", 300))
+        self._validators = {}
+        self.last_status = {}
+
+    # The clients for every controller listed in UISP_CONTROLLERS (comma
+    # separated names), or a single unnamed client if it's unset
+    @staticmethod
+    def from_env():
+        names = [
+            n.strip()
+            for n in os.getenv("UISP_CONTROLLERS", default="").split(",")
+            if n.strip()
+        ]
+        if not names:
+            return [UISPClient()]
+        return [UISPClient(n) for n in names]
+
+    # Name of this client's own env var for a setting
+    def _var(self, key):
+        if self.name is None:
+            return f"UISP_{key}"
+        return f"UISP_{self.name.upper()}_{key}"
+
+    def _env(self, key, default=None, fallback=True):
+        value = os.getenv(self._var(key))
+        if value is None and fallback:
+            value = os.getenv(f"UISP_{key}", default=default)
+        return value
+
+    # Host name for something from this controller. Names are prefixed
+    # with the controller's, so the same SSID on two controllers doesn't
+    # end up as one host.
+    def host_name(self, name):
+        if self.name is None:
+            return name
+        return f"{self.name}.{name}"
+
+    # Renames and tags a host built from this controller's data
+    def namespace(self, host):
+        if self.name is not None:
+            host.name = self.host_name(host.name)
+            host.tags["controller"] = self.name
+        return host
+
+    # Issues a GET against the UISP API and records how long it took under
+    # the given endpoint name. The body has been read (or the stream has
+    # been drained) by the time the context exits.
+    @contextmanager
+    def _get(self, name, path, **kwargs):
+        _connect_timer.seconds = 0.0
+        _connect_timer.count = 0
+        start = time.perf_counter()
+        kwargs.setdefault("timeout", self.timeout)
+        response = self.session.get(f"{self.endpoint}{path}", **kwargs)
+        try:
+            yield response
+        finally:
+            total = time.perf_counter() - start
+            headers = response.elapsed.total_seconds()
+            timing = self.timings[name]
+            timing.requests += 1
+            timing.connections += _connect_timer.count
+            timing.connect_seconds += _connect_timer.seconds
+            timing.wait_seconds += max(headers - _connect_timer.seconds, 0.0)
+            timing.transfer_seconds += max(total - headers, 0.0)
+            timing.bytes += response.raw.tell()
+            response.close()
+
+            controller = self.name or ""
+            UISP_REQUEST_SECONDS.observe(total, endpoint=name, controller=controller)
+            UISP_CONNECT_SECONDS.inc(
+                _connect_timer.seconds, endpoint=name, controller=controller
+            )
+            UISP_RESPONSE_BYTES.inc(
+                response.raw.tell(), endpoint=name, controller=controller
+            )
+
+    def timing_summary(self):
+        return "; ".join(f"{name}: {t}" for name, t in self.timings.items())
+
+    def get_devices(self):
+        with self._get("devices", "/devices") as response:
+            response.raise_for_status()
+            devices = json.loads(response.content)
 
         if devices == []:
             raise ValueError("Problem downloading UISP devices.")
 
         return devices
 
-    def get_stats(self, device_id):
+    # With start (and optionally period), both in ms, asks for just that
+    # window instead of the last hour
+    def get_stats(self, device_id, start=None, period=None, timeout=None):
         # Available interval values : hour, fourhours, day, week, month, quarter, year, range
 
-        endpoint = f"{self.endpoint}/devices/{device_id}/statistics"
-        params = {
-            # "start":int(time.time() * 1000),
-            # "period":int(11*60*1000),
-            "interval": "hour",
-        }
-        response = requests.get(
-            endpoint, headers=self.headers, params=params, verify=False
-        )
-        history = json.loads(response.content)
+        params = {"interval": "hour"}
+        if start is not None:
+            params = {"interval": "range", "start": int(start)}
+            if period is not None:
+                params["period"] = int(period)
+
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        with self._get(
+            "statistics",
+            f"/devices/{device_id}/statistics",
+            params=params,
+            **kwargs,
+        ) as response:
+            response.raise_for_status()
+            history = json.loads(response.content)
         return history
 
+    # Polling goes through stream() and the collectors; this is for --dump
     def get_data_links(self, filter=False):
-        response = requests.get(
-            f"{self.endpoint}/data-links", headers=self.headers, verify=False
-        )
-
-        data_links = json.loads(response.content)
+        with self._get("data-links", "/data-links") as response:
+            data_links = json.loads(response.content)
 
         if data_links == []:
             raise ValueError("Problem downloading UISP data_links.")
@@ -53,19 +342,90 @@ class UISPClient:
 
         return data_links
 
-    # TODO: For now, this software is only interested in Point to Point links
+    # Streams any endpoint that returns a top-level JSON array, yielding
+    # each raw element as soon as it has been parsed. With conditional=True,
+    # the validators from the last full response are sent along, and
+    # nothing is yielded if UISP answers 304 Not Modified.
+    def stream(self, path, conditional=False):
+        now = time.time()
+        headers = {}
+        validators = self._validators.get(path)
+        if conditional and validators and now - validators[2] < self.unchanged_max_age:
+            if validators[0]:
+                headers["If-None-Match"] = validators[0]
+            if validators[1]:
+                headers["If-Modified-Since"] = validators[1]
+
+        with self._get(path.strip("/"), path, stream=True, headers=headers) as response:
+            self.last_status[path] = response.status_code
+            if response.status_code == 304:
+                return
+            response.raise_for_status()
+            # The validators are only kept once the whole array has come
+            # in. Otherwise a download that broke off partway could be
+            # answered with a 304 next time, and what it missed would stay
+            # missing.
+            self._validators.pop(path, None)
+            yield from _iter_json_array(response.iter_content(STREAM_CHUNK_SIZE))
+            self._validators[path] = (
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                now,
+            )
+
+    # Only Point to Point links. PtMP links have their own collector.
     def _filter_data_links(self, data_links):
         filtered_data_links = []
         for l in data_links:
-            wireless_modes = ("ap-ptp", "sta-ptp")
-            if (
-                l["from"]["device"]["overview"]["wirelessMode"] not in wireless_modes
-                or l["to"]["device"]["overview"]["wirelessMode"] not in wireless_modes
-            ):
-                continue
-
-            # If the SSID doesn't exist, bail.
-            if l["ssid"] is None:
-                continue
-            filtered_data_links.append(l)
+            if self._is_ptp_link(l):
+                filtered_data_links.append(l)
         return filtered_data_links
+
+    @staticmethod
+    def _is_ptmp_link(l):
+        return {
+            l["from"]["device"]["overview"]["wirelessMode"],
+            l["to"]["device"]["overview"]["wirelessMode"],
+        } == {"ap-ptmp", "sta-ptmp"}
+
+    @staticmethod
+    def _is_ptp_link(l):
+        wireless_modes = ("ap-ptp", "sta-ptp")
+        if (
+            l["from"]["device"]["overview"]["wirelessMode"] not in wireless_modes
+            or l["to"]["device"]["overview"]["wirelessMode"] not in wireless_modes
+        ):
+            return False
+
+        # If the SSID doesn't exist, bail.
+        if l["ssid"] is None:
+            return False
+        return True
+
+    # Strips a data link down to the fields that DataLink actually reads
+    @staticmethod
+    def _slim_data_link(l):
+        def side(s):
+            return {
+                "site": {
+                    "identification": {"name": s["site"]["identification"]["name"]}
+                },
+                "device": {
+                    "identification": {
+                        "name": s["device"]["identification"]["name"],
+                        "model": s["device"]["identification"]["model"],
+                    },
+                    "overview": {
+                        "wirelessMode": s["device"]["overview"]["wirelessMode"]
+                    },
+                },
+                "interface": {"statistics": s["interface"]["statistics"]},
+            }
+
+        return {
+            "ssid": l["ssid"],
+            "signal": l["signal"],
+            "frequency": l["frequency"],
+            "from": side(l["from"]),
+            "to": side(l["to"]),
+        }
@@ -1,10 +1,18 @@
 from pyzabbix import ZabbixAPI
+from concurrent.futures import Future
+import copy
+import json
 import os
 import logging
+import tempfile
+import threading
+import time
 import weakref
 from enum import Enum
 
 from pyzabbix.api import ZabbixAPIException
+
+from metrics import HOST_CACHE_LOOKUPS, ZABBIX_API_CACHE, ZABBIX_API_CALLS
 from zappix.protocol import dataclass
 
 SNMP_AGENT = 20
@@ -27,6 +35,10 @@ LOG = 2
 NUMERIC_UNSIGNED = 3
 TEXT = 4
 
+# Upper bound on how many objects go into a single array-form API call, so
+# a large network doesn't turn into one enormous JSON-RPC request.
+BULK_CHUNK_SIZE = 500
+
 log = logging.getLogger("UISP2Zabbix")
 
 
@@ -38,18 +50,123 @@ class TemplateItem:
     unit: str
 
 
+def _chunks(seq, size=BULK_CHUNK_SIZE):
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
+def _tag_set(tags):
+    return {(t["tag"], t["value"]) for t in tags}
+
+
+def _session_expired(e):
+    text = str(e).lower()
+    return "re-login" in text or "not authori" in text
+
+
+# The pyzabbix client that ZabbixClient talks through. All requests share
+# one keep-alive session and auth token. On top of that, it:
+#   - counts every API request by method for the metrics endpoint
+#   - caches *.get results for cache_ttl seconds. Any write empties the
+#     cache, so nothing this broker changed is read back stale.
+#   - merges identical *.get calls that are in flight at the same time
+#     into one request
+#   - logs in again and retries once when the session has expired
+class _ZabbixAPI(ZabbixAPI):
+    def __init__(self, server, cache_ttl=30, **kwargs):
+        super().__init__(server, **kwargs)
+        self.cache_ttl = cache_ttl
+        # (method, params) -> (expiry, response)
+        self._cache = {}
+        # (method, params) -> Future for the request that's out
+        self._inflight = {}
+        # Bumped on every write, so reads that raced one aren't cached
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._login_lock = threading.Lock()
+        self._credentials = None
+
+    def login(self, user="", password="", api_token=None):
+        self._credentials = (user, password, api_token)
+        super().login(user, password, api_token)
+
+    def do_request(self, method, params=None):
+        if not method.endswith(".get"):
+            with self._lock:
+                self._cache.clear()
+                self._generation += 1
+            return self._request(method, params)
+
+        key = (method, json.dumps(params, sort_keys=True, default=str))
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                ZABBIX_API_CACHE.inc(result="hit")
+                return copy.deepcopy(cached[1])
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                generation = self._generation
+
+        if not owner:
+            ZABBIX_API_CACHE.inc(result="coalesced")
+            return copy.deepcopy(future.result())
+
+        ZABBIX_API_CACHE.inc(result="miss")
+        try:
+            response = self._request(method, params)
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+            if self.cache_ttl > 0 and generation == self._generation:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, response)
+        future.set_result(response)
+        return copy.deepcopy(response)
+
+    def _request(self, method, params):
+        auth = self.auth
+        ZABBIX_API_CALLS.inc(method=method)
+        try:
+            return super().do_request(method, params)
+        except ZabbixAPIException as e:
+            if (
+                self._credentials is None
+                or method.startswith("user.")
+                or not _session_expired(e)
+            ):
+                raise
+        # Only one thread logs in again; the rest just retry with its token
+        with self._login_lock:
+            if self.auth == auth:
+                log.warning("Zabbix session expired, logging in again")
+                self.login(*self._credentials)
+        ZABBIX_API_CALLS.inc(method=method)
+        return super().do_request(method, params)
+
+
 class ZabbixClient:
-    def __init__(self):
+    # cache_path, if given, is a JSON file that host and template IDs are
+    # saved to and loaded from, so a restart doesn't have to look every
+    # host up again before sending
+    def __init__(self, cache_path=None):
         zabbix_url = os.getenv("ZABBIX_URL")
         zabbix_uname = os.getenv("ZABBIX_UNAME")
         zabbix_pword = os.getenv("ZABBIX_PWORD")
         if zabbix_url is None or zabbix_uname is None or zabbix_pword is None:
-            log.exception(f"Zabbix credentials not provided")
+            log.exception("Zabbix credentials not provided")
             raise ValueError("Zabbix credentials not provided.")
         log.info("Logging into zabbix...")
-        self.zapi = ZabbixAPI(zabbix_url)
+        self.zapi = _ZabbixAPI(
+            zabbix_url,
+            cache_ttl=float(os.getenv("ZABBIX_API_CACHE_TTL", default=30)),
+        )
         self.zapi.login(zabbix_uname, zabbix_pword)
-        log.info(f"Logged into zabbix @ {zabbix_url}")
+        log.info("Logged into zabbix @ %s", zabbix_url)
         self._finalizer = weakref.finalize(self, self._cleanup_conn, self.zapi)
 
         # Set up template group for templates from this app if needed
@@ -62,8 +179,128 @@ class ZabbixClient:
 
         # For caching hosts
         self.host_cache = {}
+        # Host syncs can come from more than one collector thread
+        self._host_lock = threading.RLock()
+        # Host name -> why Zabbix refused to create it. These aren't tried
+        # again until a sync with update set.
+        self.rejected_hosts = {}
         self.template_cache = {}
 
+        self.cache_path = cache_path
+        self._load_cache()
+
+    # Loads the name -> ID caches saved by a previous run. Templates are
+    # checked against Zabbix straight away (it's one cheap call, and
+    # everything else hangs off them); hosts are left for
+    # validate_cache_in_background() so startup isn't held up.
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable cache %s: %s", self.cache_path, e)
+            return
+
+        self.host_cache.update(cached.get("hosts", {}))
+        self.template_cache.update(cached.get("templates", {}))
+        log.info(
+            "Loaded %s hosts and %s templates from %s",
+            len(self.host_cache),
+            len(self.template_cache),
+            self.cache_path,
+        )
+
+        if self.template_cache:
+            live = {
+                t["templateid"]: t["host"]
+                for t in self.zapi.template.get(
+                    templateids=list(self.template_cache.values()),
+                    output=["templateid", "host"],
+                )
+            }
+            self.invalidate(
+                templates=[
+                    n for n, i in self.template_cache.items() if live.get(i) != n
+                ]
+            )
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        with self._host_lock:
+            cached = {
+                "hosts": dict(self.host_cache),
+                "templates": dict(self.template_cache),
+            }
+        # Each save gets its own temp file, since HA instances can share a
+        # cache path and save at the same time
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.cache_path)),
+                prefix=f"{os.path.basename(self.cache_path)}.",
+                suffix=".tmp",
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(cached, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            log.warning("Couldn't save cache to %s: %s", self.cache_path, e)
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    # Drops cached IDs (e.g. for hosts Zabbix no longer knows about) so they
+    # get looked up or recreated on the next sync
+    def invalidate(self, hosts=(), templates=()):
+        if not hosts and not templates:
+            return
+        with self._host_lock:
+            for name in hosts:
+                self.host_cache.pop(name, None)
+            for name in templates:
+                self.template_cache.pop(name, None)
+        log.info("Invalidated %s hosts and %s templates", len(hosts), len(templates))
+        self.save_cache()
+
+    # Checks every cached host ID against Zabbix with a single host.get and
+    # drops the ones that no longer exist or now belong to another host
+    def validate_cache(self):
+        with self._host_lock:
+            cached = dict(self.host_cache)
+        if not cached:
+            return
+        live = {
+            h["hostid"]: h["host"]
+            for h in self.zapi.host.get(
+                hostids=list(cached.values()), output=["hostid", "host"]
+            )
+        }
+        self.invalidate(hosts=[n for n, i in cached.items() if live.get(i) != n])
+        log.info("Validated %s cached hosts", len(cached))
+
+    def validate_cache_in_background(self):
+        def validate():
+            try:
+                self.validate_cache()
+            except Exception as e:
+                log.exception("Got exception validating host cache: %s", e)
+
+        threading.Thread(target=validate, name="cache-validate", daemon=True).start()
+
+    # Fills the host cache with every host linked to the given templates, so
+    # that a standby broker can take over without looking any of them up
+    def warm_cache(self, template_ids):
+        hosts = self.zapi.host.get(
+            templateids=list(template_ids), output=["hostid", "host"]
+        )
+        with self._host_lock:
+            for h in hosts:
+                self.host_cache[h["host"]] = h["hostid"]
+        self.save_cache()
+        log.info("Warmed host cache with %s hosts", len(hosts))
+
     @staticmethod
     def _cleanup_conn(zapi):
         zapi.user.logout()
@@ -80,17 +317,19 @@ class ZabbixClient:
             )
 
             if existing_groups:
-                print(f"Template group '{template_group_name}' already exists.")
+                log.info("Template group '%s' already exists.", template_group_name)
                 return existing_groups[0]["groupid"]
 
             # Create the template group if it doesn't exist
             created_group = self.zapi.templategroup.create(name=template_group_name)
-            print(
-                f"Template group '{template_group_name}' created with ID: {created_group['groupids'][0]}"
+            log.info(
+                "Template group '%s' created with ID: %s",
+                template_group_name,
+                created_group["groupids"][0],
             )
             return created_group["groupids"][0]
         except ZabbixAPIException as e:
-            print(f"Error creating template group: {e}")
+            log.error("Error creating template group: %s", e)
             return None
 
     # Queries the Zabbix API to check if a host group by the given name
@@ -103,32 +342,40 @@ class ZabbixClient:
             existing_groups = self.zapi.hostgroup.get(filter={"name": host_group_name})
 
             if existing_groups:
-                print(f"host group '{host_group_name}' already exists.")
+                log.info("host group '%s' already exists.", host_group_name)
                 return existing_groups[0]["groupid"]
 
             # Create the host group if it doesn't exist
             created_group = self.zapi.hostgroup.create(name=host_group_name)
-            print(
-                f"host group '{host_group_name}' created with ID: {created_group['groupids'][0]}"
+            log.info(
+                "host group '%s' created with ID: %s",
+                host_group_name,
+                created_group["groupids"][0],
             )
             return created_group["groupids"][0]
         except ZabbixAPIException as e:
-            print(f"Error creating host group: {e}")
+            log.error("Error creating host group: %s", e)
             return None
 
     # Queries the Zabbix API to check if a template by the given name
     # exists, creates one if it doesn't, and returns the ID of that template
-    # Parameters: template_name (Name of template)
+    # Parameters: data_class, template_group_id (Optional), template_name
+    # (Optional, defaults to one named after data_class)
     # Returns: template_id (ID of template)
-    def get_or_create_template(self, data_class, template_group_id=None):
+    def get_or_create_template(
+        self, data_class, template_group_id=None, template_name=None
+    ):
         if template_group_id is None:
             template_group_id = self.default_template_group_id
-        template_name = f"{data_class.__name__} by UISPZabbix"
+        if template_name is None:
+            template_name = f"{data_class.__name__} by UISPZabbix"
 
         # Check our cache for the template
         if template_name in self.template_cache.keys():
             template_id = self.template_cache[template_name]
-            log.info(f"Found Template '{template_name}' with ID {template_id} in cache")
+            log.debug(
+                "Found Template '%s' with ID %s in cache", template_name, template_id
+            )
             return (template_id, False)
 
         try:
@@ -136,128 +383,276 @@ class ZabbixClient:
             template = self.zapi.template.get(filter={"host": template_name})
             if template:
                 log.info(
-                    f"Found Template '{template_name}' with ID {template[0]['templateid']}"
+                    "Found Template '%s' with ID %s",
+                    template_name,
+                    template[0]["templateid"],
                 )
+                self.template_cache[template_name] = template[0]["templateid"]
+                self.save_cache()
                 return (template[0]["templateid"], False)
 
             # If not, create it
             template = self.zapi.template.create(
                 {"host": template_name, "groups": [{"groupid": template_group_id}]}
             )
-            print(
-                f"Template '{template_name}' created with ID {template['templateids'][0]}"
+            log.info(
+                "Template '%s' created with ID %s",
+                template_name,
+                template["templateids"][0],
             )
+            self.template_cache[template_name] = template["templateids"][0]
+            self.save_cache()
             return (template["templateids"][0], True)
 
         except ZabbixAPIException as e:
-            print(f"Error getting template: {e}")
+            log.error("Error getting template: %s", e)
             return (None, False)
 
-    # Queries the Zabbix API to check if a item by the given name
-    # exists, creates one if it doesn't, and returns the ID of that item
-    # Parameters: item_name (Name of item), key, info_type, unit
-    # Returns: item_id (ID of item)
-    def get_or_create_template_item(
-        self, template_id, name, key, value_type, unit=None, update=False
-    ):
-        log.info(f"Creating {key}")
-
-        if unit is None:
-            unit = ""
-
-        try:
-            # Check if the item exists
-            item = self.zapi.item.get(filter={"key_": key}, templateids=[template_id])
-
-            if item:
-                item_info = item[0]
-                log.info(
-                    f"Item found: {item_info['name']} (Item ID: {item_info['itemid']}, Key: {item_info['key_']})"
+    # Brings the items on a template in line with a list of TemplateItems.
+    # Every item on the template is fetched with one item.get, compared by
+    # key, and the differences go out as array-form item.create, item.update
+    # and item.delete calls. Fields that already match are not rewritten.
+    # With rule_id, the same is done for the item prototypes of that
+    # discovery rule instead.
+    # Parameters: template_id, items (list of TemplateItem), delete (Optional),
+    # rule_id (Optional)
+    # Returns: (created, updated, deleted) counts
+    def sync_template_items(self, template_id, items, delete=True, rule_id=None):
+        if rule_id is None:
+            api = self.zapi.item
+            scope = {"templateids": [template_id]}
+            extra = {}
+        else:
+            api = self.zapi.itemprototype
+            scope = {"discoveryids": [rule_id]}
+            extra = {"ruleid": rule_id}
+        existing = {
+            i["key_"]: i
+            for i in api.get(
+                output=["itemid", "name", "key_", "type", "value_type", "units"],
+                **scope,
+            )
+        }
+
+        to_create = []
+        to_update = []
+        for item in items:
+            wanted = {
+                "name": item.name,
+                "type": TRAPPER,
+                "value_type": item.value_type,
+                "units": item.unit or "",
+            }
+            current = existing.pop(item.key, None)
+            if current is None:
+                to_create.append(
+                    {"key_": item.key, "hostid": template_id, **extra, **wanted}
                 )
-                if update:
-                    self.zapi.item.update(
-                        itemid=item_info["itemid"],
-                        name=name,
-                        key_=key,
-                        # hostid = template_id,
-                        type=TRAPPER,
-                        value_type=value_type,
-                        units=unit,
-                    )["itemids"][0]
-
-                    log.info(
-                        f"Item '{name}' updated successfully with item ID {item_info['itemid']}"
-                    )
-
-                return item_info["itemid"]
-
-            # If not, create it
-            log.info(f"Item with key '{key}' not found.")
-
-            # Create trapper item
-            item_id = self.zapi.item.create(
-                name=name,
-                key_=key,
-                hostid=template_id,
-                type=TRAPPER,
-                value_type=value_type,
-                units=unit,
-            )["itemids"][0]
-
-            log.info(f"Item '{key}' created successfully with item ID {item_id}")
-
-            return item_id
-        except ZabbixAPIException as e:
-            log.exception(f"Error: {e}")
-            return None
-
-    def get_or_create_host(self, host, template_id, host_group_id=None, update=False):
-        host_name = host.name
-        host_tags = []
-        for k, v in host.tags.items():
-            host_tags.append({"tag": k, "value": v})
-
+                continue
+
+            # The API hands everything back as strings
+            changed = {k: v for k, v in wanted.items() if str(current[k]) != str(v)}
+            if changed:
+                to_update.append({"itemid": current["itemid"], **changed})
+
+        # Whatever is left on the template no longer has a matching item
+        to_delete = [i["itemid"] for i in existing.values()] if delete else []
+
+        for chunk in _chunks(to_create):
+            api.create(*chunk)
+        for chunk in _chunks(to_update):
+            api.update(*chunk)
+        for chunk in _chunks(to_delete):
+            api.delete(*chunk)
+
+        log.info(
+            "Synced template %s: %s created, %s updated, %s deleted",
+            template_id,
+            len(to_create),
+            len(to_update),
+            len(to_delete),
+        )
+        return (len(to_create), len(to_update), len(to_delete))
+
+    # Finds (or creates) a trapper low-level discovery rule on a template
+    # Parameters: template_id, key, name, lifetime (Optional; how long
+    # discovered entities stay after they stop being discovered)
+    # Returns: rule_id (ID of discovery rule)
+    def get_or_create_discovery_rule(self, template_id, key, name, lifetime="7d"):
+        rules = self.zapi.discoveryrule.get(
+            templateids=[template_id], filter={"key_": key}, output=["itemid"]
+        )
+        if rules:
+            return rules[0]["itemid"]
+        rule_id = self.zapi.discoveryrule.create(
+            name=name, key_=key, hostid=template_id, type=TRAPPER, lifetime=lifetime
+        )["itemids"][0]
+        log.info("Discovery rule '%s' created with ID %s", key, rule_id)
+        return rule_id
+
+    # Brings a discovery rule's host prototype in line with what's wanted,
+    # creating it if needed. Discovered hosts get linked to template_id.
+    # Parameters: rule_id, host (usually an LLD macro), template_id,
+    # tags (dict, values usually LLD macros), host_group_id (Optional)
+    # Returns: host_prototype_id
+    def sync_host_prototype(
+        self, rule_id, host, template_id, tags=None, host_group_id=None
+    ):
         if host_group_id is None:
             host_group_id = self.default_host_group_id
-
-        # Check our cache for the host
-        if not update and host_name in self.host_cache.keys():
-            host_id = self.host_cache[host_name]
-            log.info(f"Found Host '{host_name}' with ID {host_id} in cache")
+        wanted = {
+            "groupLinks": [{"groupid": host_group_id}],
+            "templates": [{"templateid": template_id}],
+            "tags": [{"tag": k, "value": v} for k, v in (tags or {}).items()],
+        }
+        existing = self.zapi.hostprototype.get(
+            discoveryids=[rule_id], filter={"host": host}, output=["hostid"]
+        )
+        if existing:
+            host_id = existing[0]["hostid"]
+            self.zapi.hostprototype.update(hostid=host_id, **wanted)
             return host_id
+        host_id = self.zapi.hostprototype.create(host=host, ruleid=rule_id, **wanted)[
+            "hostids"
+        ][0]
+        log.info("Host prototype '%s' created with ID %s", host, host_id)
+        return host_id
 
-        # Check if the host already exists
-        existing_host = self.zapi.host.get(filter={"host": host_name})
-
-        if existing_host:
-            # Host already exists, return its ID
-            host_id = existing_host[0]["hostid"]
-            log.info(f"Host '{host_name}' already exists with ID {host_id}")
-            if update:
-                host_update_params = {
-                    "hostid": host_id,
-                    "name": host_name,
-                    "groups": [{"groupid": host_group_id}],
-                    "templates": [{"templateid": template_id}],
-                    "tags": host_tags,
-                }
-
-                host_info = self.zapi.host.update(host_update_params)
-                host_id = host_info["hostids"][0]
-                log.info(f"Host '{host_name}' updated with ID {host_id}")
-        else:
-            # Host doesn't exist, create it
-            host_create_params = {
-                "host": host_name,
-                "name": host_name,
+    @staticmethod
+    def _host_tags(host):
+        return [{"tag": k, "value": v} for k, v in host.tags.items()]
+
+    def _get_hosts(self, **params):
+        return self.zapi.host.get(
+            output=["hostid", "host", "name"],
+            selectTags=["tag", "value"],
+            selectParentTemplates=["templateid"],
+            selectHostGroups=["groupid"],
+            **params,
+        )
+
+    # Reconciles a whole set of hosts against Zabbix in bulk instead of one
+    # host.get per host. Every host in the host group is fetched with a
+    # single call (filling host_cache), missing hosts are made with an
+    # array-form host.create, and if update is set, hosts whose group or
+    # template drifted are fixed with host.massupdate while hosts whose name
+    # or tags drifted get an array-form host.update (tags differ per host,
+    # so massupdate can't carry them). Zabbix refuses a whole host.create if
+    # any one host in it is invalid (e.g. a name with characters it doesn't
+    # allow), so a chunk that fails is retried one host at a time, and the
+    # hosts that still fail are left out of later syncs (see
+    # rejected_hosts).
+    # Parameters: hosts (HostProto objects), template_id, host_group_id (Optional), update
+    # Returns: dict of host name -> host ID for the given hosts that exist
+    def sync_hosts(self, hosts, template_id, host_group_id=None, update=False):
+        with self._host_lock:
+            return self._sync_hosts(hosts, template_id, host_group_id, update)
+
+    def _sync_hosts(self, hosts, template_id, host_group_id, update):
+        if host_group_id is None:
+            host_group_id = self.default_host_group_id
+
+        if update:
+            self.rejected_hosts.clear()
+        wanted = {h.name: h for h in hosts if h.name not in self.rejected_hosts}
+
+        hits = sum(1 for name in wanted if name in self.host_cache)
+        HOST_CACHE_LOOKUPS.inc(hits, result="hit")
+        HOST_CACHE_LOOKUPS.inc(len(wanted) - hits, result="miss")
+
+        # Nothing new and nothing to fix, so no need to talk to Zabbix
+        if not update and hits == len(wanted):
+            return {name: self.host_cache[name] for name in wanted}
+
+        existing = {}
+        if update or not self.host_cache:
+            for h in self._get_hosts(groupids=[host_group_id]):
+                existing[h["host"]] = h
+
+        # Hosts can live outside our group (or just be new since the cache
+        # was filled), so look up whatever is left in one more call before
+        # deciding what to create.
+        unknown = [
+            name
+            for name in wanted
+            if name not in existing and (update or name not in self.host_cache)
+        ]
+        if unknown:
+            for h in self._get_hosts(filter={"host": unknown}):
+                existing[h["host"]] = h
+
+        for name, h in existing.items():
+            self.host_cache[name] = h["hostid"]
+        self.save_cache()
+
+        to_create = [
+            {
+                "host": name,
+                "name": name,
                 "groups": [{"groupid": host_group_id}],
                 "templates": [{"templateid": template_id}],
-                "tags": host_tags,
+                "tags": self._host_tags(wanted[name]),
             }
+            for name in unknown
+            if name not in existing
+        ]
+        created = 0
+        for chunk in _chunks(to_create):
+            try:
+                host_ids = self.zapi.host.create(*chunk)["hostids"]
+            except ZabbixAPIException as e:
+                log.warning(
+                    "Creating %s hosts at once failed (%s), trying them one by one",
+                    len(chunk),
+                    e,
+                )
+                host_ids = [self._create_host(params) for params in chunk]
+            for params, host_id in zip(chunk, host_ids):
+                if host_id is not None:
+                    self.host_cache[params["host"]] = host_id
+                    created += 1
+        if to_create:
+            log.info("Created %s hosts", created)
+            self.save_cache()
+
+        if update:
+            relink = []
+            retag = []
+            for name, h in existing.items():
+                if name not in wanted:
+                    continue
+                groups = {g["groupid"] for g in h.get("hostgroups", [])}
+                templates = {t["templateid"] for t in h.get("parentTemplates", [])}
+                if groups != {host_group_id} or templates != {template_id}:
+                    relink.append({"hostid": h["hostid"]})
+
+                tags = self._host_tags(wanted[name])
+                if h["name"] != name or _tag_set(h.get("tags", [])) != _tag_set(tags):
+                    retag.append({"hostid": h["hostid"], "name": name, "tags": tags})
+
+            for chunk in _chunks(relink):
+                self.zapi.host.massupdate(
+                    hosts=chunk,
+                    groups=[{"groupid": host_group_id}],
+                    templates=[{"templateid": template_id}],
+                )
+            for chunk in _chunks(retag):
+                self.zapi.host.update(*chunk)
+            log.info(
+                "Updated hosts: %s relinked, %s renamed/retagged",
+                len(relink),
+                len(retag),
+            )
 
-            host_info = self.zapi.host.create(host_create_params)
-            host_id = host_info["hostids"][0]
-            log.info(f"Host '{host_name}' created with ID {host_id}")
+        return {
+            name: self.host_cache[name] for name in wanted if name in self.host_cache
+        }
 
-        self.host_cache[host_name] = host_id
-        return host_id
+    # Creates one host. Returns its ID, or None if Zabbix refused it.
+    def _create_host(self, params):
+        try:
+            return self.zapi.host.create(params)["hostids"][0]
+        except ZabbixAPIException as e:
+            log.error("Zabbix refused to create host '%s': %s", params["host"], e)
+            self.rejected_hosts[params["host"]] = str(e)
+            return None